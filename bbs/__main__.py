@@ -1,18 +1,142 @@
+import argparse
 import asyncio
+import logging
+import os
+import tempfile
 
-from bbs.telnet import start_telnet
-from bbs.models import models_init, models_cleanup
+from bbs.chat import configure_chat, get_chat
+from bbs.connections import configure_connections, get_connections
+from bbs.metrics import start_metrics, stop_metrics
+from bbs.telnet import configure_login_limits, start_telnet
+from bbs.models import DEFAULT_DB_URL, configure_database, models_init, models_cleanup
+from bbs.security import configure_breach_check, configure_hasher, security_cleanup
+from bbs.watchdog import start_watchdog, stop_watchdog
 
-async def main():
+async def main(host='', port=6023, metrics_port=None, metrics_host='127.0.0.1',
+               stall_threshold=0.25, stall_log=None):
     try:
         db = await models_init()
-        tserver = await start_telnet()
+        await start_metrics(metrics_port, metrics_host)
+        start_watchdog(stall_threshold, stall_log)
+        tserver = await start_telnet(host=host, port=port)
         async with tserver:
             await asyncio.gather(tserver.serve_forever())
     finally:
+        await get_connections().close()
+        stop_watchdog()
+        await stop_metrics()
+        await get_chat().close()
         await models_cleanup()
+        await security_cleanup()
 
-try:
-    asyncio.run(main())
-except KeyboardInterrupt:
-    pass
\ No newline at end of file
+parser = argparse.ArgumentParser(prog='bbs')
+parser.add_argument('--host', default='')
+parser.add_argument('--port', type=int, default=6023)
+parser.add_argument(
+    '--workers', type=int, default=1,
+    help="pre-fork this many worker processes sharing the listening socket; "
+         "each keeps its own login rate limits, so they allow up to N times as many attempts",
+)
+parser.add_argument(
+    '--bus', default=os.path.join(tempfile.gettempdir(), 'bbs-chat.sock'),
+    help="unix socket the workers use to share chat (with --workers)",
+)
+parser.add_argument(
+    '--db', default=None,
+    help=f"database URL (default: $BBS_DB_URL or {DEFAULT_DB_URL}); SQLite pragmas "
+         "can be given as query parameters, e.g. sqlite://bbs.db?synchronous=FULL",
+)
+parser.add_argument(
+    '--read-connections', type=int, default=None,
+    help="read-only SQLite connections per process for logins and listings",
+)
+parser.add_argument(
+    '--history', type=int, default=None,
+    help="lines of history kept per chat channel (default 200)",
+)
+parser.add_argument(
+    '--history-bytes', type=int, default=None,
+    help="bytes of message text kept per chat channel (default 65536)",
+)
+parser.add_argument(
+    '--replay', type=int, default=None,
+    help="history lines shown on joining a channel (default 20)",
+)
+parser.add_argument(
+    '--chat-log', action='store_true',
+    help="also record chat lines in the database",
+)
+parser.add_argument(
+    '--hasher', choices=['process', 'thread'], default='process',
+    help="executor used for argon2 hashing and verification",
+)
+parser.add_argument('--hash-workers', type=int, default=None)
+parser.add_argument(
+    '--breach-corpus', default=None,
+    help="sorted Pwned Passwords SHA1 file to check against instead of the API",
+)
+parser.add_argument('--no-breach-api', dest='breach_api', action='store_false')
+parser.add_argument(
+    '--idle-timeout', type=float, default=1800.0,
+    help="disconnect logged-in sessions idle this many seconds (0 to disable)",
+)
+parser.add_argument(
+    '--login-timeout', type=float, default=120.0,
+    help="disconnect connections that have not logged in after being idle this long",
+)
+parser.add_argument(
+    '--max-sessions', type=int, default=None,
+    help="refuse connections beyond this many per process",
+)
+parser.add_argument(
+    '--no-login-limits', dest='login_limits', action='store_false',
+    help="do not rate-limit login attempts (for local load testing); "
+         "the limits are kept per worker process, not shared between --workers",
+)
+parser.add_argument(
+    '--metrics-port', type=int, default=None,
+    help="serve Prometheus metrics over HTTP on this port (worker n uses port + n)",
+)
+parser.add_argument('--metrics-host', default='127.0.0.1')
+parser.add_argument(
+    '--stall-threshold', type=float, default=0.25,
+    help="log a stack sample when the event loop is stuck this many seconds (0 to disable)",
+)
+parser.add_argument(
+    '--stall-log', default=None,
+    help="rotating log file for stall reports (each worker process appends .<pid>)",
+)
+parser.add_argument('--heartbeat', type=float, default=5.0)
+parser.add_argument('--grace', type=float, default=30.0)
+args = parser.parse_args()
+logging.basicConfig(level=logging.INFO)
+configure_database(args.db, args.read_connections)
+configure_chat(args.history, args.replay, log=args.chat_log, history_bytes=args.history_bytes)
+configure_login_limits(args.login_limits)
+configure_connections(args.idle_timeout, args.login_timeout, args.max_sessions)
+configure_hasher(args.hasher, args.hash_workers)
+configure_breach_check(args.breach_corpus, remote=args.breach_api)
+
+if args.workers > 1:
+    from bbs.supervisor import Supervisor
+    Supervisor(
+        args.workers,
+        host=args.host,
+        port=args.port,
+        bus_path=args.bus,
+        heartbeat=args.heartbeat,
+        timeout=args.heartbeat * 6,
+        grace=args.grace,
+        metrics_port=args.metrics_port,
+        metrics_host=args.metrics_host,
+        stall_threshold=args.stall_threshold,
+        stall_log=args.stall_log,
+    ).run()
+else:
+    try:
+        asyncio.run(main(
+            args.host, args.port, args.metrics_port, args.metrics_host,
+            args.stall_threshold, args.stall_log,
+        ))
+    except KeyboardInterrupt:
+        pass
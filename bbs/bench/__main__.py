@@ -0,0 +1,81 @@
+import argparse
+import asyncio
+import datetime
+import json
+import platform
+import sys
+
+from bbs.bench.load import run_load
+from bbs.bench.micro import run_micro
+
+
+async def serve(args):
+    # A server in this process, with login limits off.  The clients share
+    # its CPU, so numbers from here are for comparing builds, not capacity.
+    from bbs.models import models_init, models_cleanup
+    from bbs.security import configure_hasher, security_cleanup
+    from bbs.telnet import configure_login_limits, start_telnet
+    configure_login_limits(False)
+    configure_hasher('thread')
+    await models_init()
+    server = await start_telnet(host='127.0.0.1', port=0)
+    try:
+        port = server.sockets[0].getsockname()[1]
+        return await run_load(
+            '127.0.0.1', port, args.clients, args.duration, args.scenario,
+            args.user, args.password, args.ramp, args.interval,
+        )
+    finally:
+        server.close()
+        await models_cleanup()
+        await security_cleanup()
+
+
+async def main(args):
+    if args.command == 'micro':
+        results = await run_micro(args.repeat)
+    elif args.serve:
+        results = await serve(args)
+    else:
+        results = await run_load(
+            args.host, args.port, args.clients, args.duration, args.scenario,
+            args.user, args.password, args.ramp, args.interval,
+        )
+    return {
+        'benchmark': args.command,
+        'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+
+parser = argparse.ArgumentParser(prog='python -m bbs.bench')
+parser.add_argument('--output', '-o', default=None, help="write the JSON here instead of stdout")
+commands = parser.add_subparsers(dest='command', required=True)
+micro = commands.add_parser('micro', help="line editor, read buffer and chat fan-out micro-benchmarks")
+micro.add_argument('--repeat', type=int, default=5)
+load = commands.add_parser('load', help="drive simulated telnet sessions against a server")
+load.add_argument('--host', default='127.0.0.1')
+load.add_argument('--port', type=int, default=6023)
+load.add_argument(
+    '--serve', action='store_true',
+    help="start a server in this process on a free port instead",
+)
+load.add_argument('--clients', type=int, default=50)
+load.add_argument('--duration', type=float, default=30.0)
+load.add_argument('--ramp', type=float, default=5.0, help="seconds over which to start the clients")
+load.add_argument('--interval', type=float, default=0.5, help="mean pause between commands or messages")
+load.add_argument('--scenario', choices=['browse', 'chat'], default='browse')
+load.add_argument('--user', action='append', default=None, help="log in as this user (repeat to rotate)")
+load.add_argument('--password', default='password')
+args = parser.parse_args()
+if args.command == 'load' and not args.user:
+    args.user = ['admin']
+
+report = json.dumps(asyncio.run(main(args)), indent=2)
+if args.output:
+    with open(args.output, 'w') as fp:
+        fp.write(report + '\n')
+else:
+    sys.stdout.write(report + '\n')
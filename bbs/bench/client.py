@@ -0,0 +1,118 @@
+import asyncio
+import re
+
+IAC, SB, SE = 255, 250, 240
+WILL, WONT, DO, DONT = 251, 252, 253, 254
+ECHO, SGA = 1, 3
+
+_ESCAPE = re.compile(r'\x1b(\[[0-9;?]*[ -/]*[@-~]|.)')
+
+
+# A scripted telnet client: enough of the protocol to get through
+# telnetlib3's negotiation (it agrees to server echo and suppress-go-ahead
+# and refuses everything else) and to answer the cursor position queries
+# Readline sends, then plain text in and out.
+class SimClient:
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._pending = b''
+        self.text = ''
+        self.received = 0
+
+    @classmethod
+    async def connect(cls, host, port):
+        return cls(*await asyncio.open_connection(host, port))
+
+    def send(self, text):
+        self._writer.write(text.encode('utf8'))
+
+    async def expect(self, marker, timeout=10.0):
+        # Read until marker shows up, then drop everything up to and
+        # including it from self.text.
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while (index := self.text.find(marker)) < 0:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError(f"no {marker!r} from the server")
+            data = await asyncio.wait_for(self._reader.read(65536), remaining)
+            if not data:
+                raise ConnectionError("server closed the connection")
+            self.received += len(data)
+            self._feed(data)
+        text = self.text[:index]
+        self.text = self.text[index + len(marker):]
+        return text
+
+    async def receive(self):
+        # Whatever has arrived, waiting for at least one read; '' once the
+        # server hangs up.
+        if not self.text:
+            data = await self._reader.read(65536)
+            if not data:
+                return ''
+            self.received += len(data)
+            self._feed(data)
+        text, self.text = self.text, ''
+        return text
+
+    def _feed(self, data):
+        data = self._pending + data
+        self._pending = b''
+        out = bytearray()
+        i = 0
+        while i < len(data):
+            byte = data[i]
+            if byte != IAC:
+                out.append(byte)
+                i += 1
+                continue
+            if i + 1 >= len(data):
+                break
+            verb = data[i + 1]
+            if verb in (WILL, WONT, DO, DONT):
+                if i + 2 >= len(data):
+                    break
+                option = data[i + 2]
+                if verb == WILL:
+                    self._writer.write(bytes([IAC, DO if option in (ECHO, SGA) else DONT, option]))
+                elif verb == DO:
+                    self._writer.write(bytes([IAC, WONT, option]))
+                i += 3
+            elif verb == SB:
+                end = data.find(bytes([IAC, SE]), i)
+                if end < 0:
+                    break
+                i = end + 2
+            elif verb == IAC:
+                out.append(IAC)
+                i += 2
+            else:
+                i += 2
+        self._pending = data[i:]
+        text = out.decode('utf8', 'replace')
+        while (query := text.find('\x1b[6n')) >= 0:
+            before = self.text + text[:query]
+            line = _ESCAPE.sub('', before[before.rfind('\r') + 1:])
+            self._writer.write(f'\x1b[1;{len(line) + 1}R'.encode())
+            text = text[:query] + text[query + 4:]
+        self.text += text
+
+    async def login(self, username, password, prompt='>>> '):
+        await self.expect('username: ')
+        self.send(username + '\r')
+        await self.expect('password: ')
+        self.send(password + '\r')
+        await self.expect(prompt)
+
+    async def command(self, line, prompt='>>> ', timeout=10.0):
+        self.send(line + '\r')
+        return await self.expect(prompt, timeout)
+
+    async def close(self):
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except ConnectionError:
+            pass
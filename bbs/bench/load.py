@@ -0,0 +1,134 @@
+import asyncio
+import contextlib
+import random
+import re
+import time
+
+from bbs.bench.client import SimClient
+
+BROWSE_COMMANDS = ['ls', 'pwd', 'cd /', 'ls /users', 'who', 'help']
+# A chat line as delivered to a room, as opposed to our own typing echoed.
+_DELIVERED = re.compile(r'<[^>\s]+> bench-')
+
+
+def summarize(samples):
+    # Latency samples in seconds -> milliseconds at a few percentiles.
+    if not samples:
+        return {'count': 0}
+    samples = sorted(samples)
+
+    def at(fraction):
+        return round(samples[min(len(samples) - 1, int(fraction * len(samples)))] * 1000, 3)
+    return {
+        'count': len(samples),
+        'mean_ms': round(sum(samples) / len(samples) * 1000, 3),
+        'p50_ms': at(0.5),
+        'p90_ms': at(0.9),
+        'p99_ms': at(0.99),
+        'max_ms': round(samples[-1] * 1000, 3),
+    }
+
+
+class LoadStats:
+    def __init__(self):
+        self.logins = []
+        self.commands = []
+        self.sent = 0
+        self.delivered = 0
+        self.errors = {}
+        self.bytes_received = 0
+
+    def error(self, exc):
+        name = type(exc).__name__
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+
+async def _session(index, host, port, scenario, users, password, stop, stats, interval):
+    client = None
+    try:
+        started = time.perf_counter()
+        client = await SimClient.connect(host, port)
+        await client.login(users[index % len(users)], password)
+        stats.logins.append(time.perf_counter() - started)
+        if scenario == 'browse':
+            await _browse(client, stop, stats, interval)
+        else:
+            await _chat(client, index, stop, stats, interval)
+    except (OSError, EOFError, asyncio.TimeoutError) as exc:
+        stats.error(exc)
+    finally:
+        if client is not None:
+            stats.bytes_received += client.received
+            await client.close()
+
+
+async def _browse(client, stop, stats, interval):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await client.command(random.choice(BROWSE_COMMANDS))
+        stats.commands.append(time.perf_counter() - started)
+        if interval:
+            await asyncio.sleep(random.uniform(0, 2 * interval))
+
+
+async def _chat(client, index, stop, stats, interval):
+    await client.command('chat', prompt='#lobby> ')
+
+    async def listen():
+        tail = ''
+        while text := await client.receive():
+            text = tail + text
+            end = 0
+            for match in _DELIVERED.finditer(text):
+                stats.delivered += 1
+                end = match.end()
+            tail = text[end:][-64:]
+
+    listener = asyncio.create_task(listen())
+    try:
+        seq = 0
+        while not stop.is_set():
+            client.send(f'bench-{index}-{seq}\r')
+            stats.sent += 1
+            seq += 1
+            await asyncio.sleep(random.uniform(0, 2 * interval) if interval else 0)
+    finally:
+        listener.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await listener
+
+
+async def run_load(host='127.0.0.1', port=6023, clients=50, duration=30.0,
+                   scenario='browse', users=('admin',), password='password',
+                   ramp=5.0, interval=0.5):
+    # clients sessions are started evenly over ramp seconds and all stopped
+    # duration seconds after the first one; in the chat scenario every
+    # message is counted once per session that sees it.
+    stats = LoadStats()
+    stop = asyncio.Event()
+    tasks = []
+    started = time.perf_counter()
+    for index in range(clients):
+        tasks.append(asyncio.create_task(_session(
+            index, host, port, scenario, list(users), password, stop, stats, interval,
+        )))
+        if ramp:
+            await asyncio.sleep(ramp / clients)
+    await asyncio.sleep(max(0.0, duration - (time.perf_counter() - started)))
+    stop.set()
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    return {
+        'scenario': scenario,
+        'clients': clients,
+        'seconds': round(elapsed, 3),
+        'logins': summarize(stats.logins),
+        'logins_per_sec': round(len(stats.logins) / elapsed, 2),
+        'commands': summarize(stats.commands),
+        'commands_per_sec': round(len(stats.commands) / elapsed, 2),
+        'messages_sent': stats.sent,
+        'messages_delivered': stats.delivered,
+        'deliveries_per_sec': round(stats.delivered / elapsed, 2),
+        'bytes_received': stats.bytes_received,
+        'errors': stats.errors,
+    }
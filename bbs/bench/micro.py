@@ -0,0 +1,125 @@
+import asyncio
+import time
+import types
+
+from bbs.chat import Chat, ChatClient
+from bbs.presence import Presence
+from bbs.readline import _ReadBuffer
+from bbs.readline.readlike import LineEditor, edit
+
+LINE = 'the quick brown fox jumps over the lazy dog ' * 2
+PASTE = ''.join(f'pasted line {i} with some text on it\n' for i in range(2000))
+
+
+def _result(name, ops, seconds, **extra):
+    return dict(
+        name=name,
+        ops=ops,
+        seconds=round(seconds, 6),
+        ops_per_sec=round(ops / seconds, 1) if seconds else None,
+        ns_per_op=round(seconds / ops * 1e9, 1) if ops else None,
+        **extra,
+    )
+
+
+def _best(func, repeat):
+    # Best of a few runs, which is the least disturbed by everything else.
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+async def _abest(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def bench_edit(repeat=5, lines=200):
+    def typed():
+        for _ in range(lines):
+            text, pos = '', 0
+            for key in LINE:
+                text, pos = edit(text, pos, key)
+
+    def fed():
+        for _ in range(lines):
+            editor = LineEditor(5)
+            for key in LINE:
+                editor.feed(key)
+
+    def midline():
+        for _ in range(lines):
+            editor = LineEditor(5)
+            for key in LINE:
+                editor.feed(key)
+                editor.feed('\x02')
+    keys = lines * len(LINE)
+    return [
+        _result('readlike.edit', keys, _best(typed, repeat)),
+        _result('LineEditor.feed', keys, _best(fed, repeat)),
+        _result('LineEditor.feed midline', keys * 2, _best(midline, repeat)),
+    ]
+
+
+class _FakeReader:
+    # Hands out a fixed text the way the telnet reader does: up to n
+    # characters per read.
+    def __init__(self, text):
+        self._text = text
+        self._start = 0
+
+    async def read(self, n=-1):
+        if n < 0:
+            n = len(self._text)
+        chunk = self._text[self._start:self._start + n]
+        self._start += len(chunk)
+        return chunk
+
+
+async def bench_readbuffer(repeat=5):
+    async def by_char():
+        buffer = _ReadBuffer(_FakeReader(PASTE))
+        while (char := buffer.pop_nowait()) is not None or (char := await buffer.pop()):
+            pass
+
+    async def by_line():
+        buffer = _ReadBuffer(_FakeReader(PASTE))
+        for _ in range(PASTE.count('\n')):
+            await buffer.readuntil('\n')
+    return [
+        _result('_ReadBuffer chars', len(PASTE), await _abest(by_char, repeat)),
+        _result('_ReadBuffer readuntil', PASTE.count('\n'), await _abest(by_line, repeat)),
+    ]
+
+
+async def bench_chat_send(repeat=5, clients=100, messages=1000):
+    chat = Chat(queue_size=messages, presence=Presence())
+    members = [
+        ChatClient(chat, types.SimpleNamespace(username=f'bench{i}'), None, None, queue_size=messages)
+        for i in range(clients)
+    ]
+    for client in members:
+        await chat.join(client, '#bench')
+
+    async def send():
+        for client in members:
+            client._outbox.clear()
+        for i in range(messages):
+            await chat.send(f'message {i}', '#bench', 'bench0')
+    return [
+        _result('Chat.send', messages, await _abest(send, repeat), fanout=clients),
+    ]
+
+
+async def run_micro(repeat=5):
+    results = bench_edit(repeat)
+    results += await bench_readbuffer(repeat)
+    results += await bench_chat_send(repeat)
+    return results
@@ -0,0 +1,206 @@
+import asyncio
+import collections
+import contextlib
+import json
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+# Everything that crosses the bus is a small dict:
+#   {'type': 'message', 'channel': ..., 'text': ...}
+#   {'type': 'broadcast', 'text': ...}
+#   {'type': 'join' | 'part', 'channel': ..., 'username': ...}
+#   {'type': 'sessions' | 'kick' | 'sessions_reply', ...}  (see bbs.connections)
+# plus a local-only {'type': 'reset'} when a bus (re)connects and every
+# presence entry the subscriber knows about is stale.
+#
+# Both ends read with a line limit of MAX_LINE, and publishers drop anything
+# longer instead of sending a line the other end would choke on.
+MAX_LINE = 1 << 18
+
+
+def _encode(event):
+    return json.dumps(event, separators=(',', ':')).encode('utf8') + b'\n'
+
+
+def _presence_key(event):
+    return event.get('channel'), event.get('username')
+
+
+# In-process bus: publishing hands the event straight back to the subscriber.
+class LocalBus:
+    # How many processes hear each event, when that is known.
+    processes = 1
+
+    def __init__(self, handler=None):
+        self._handler = handler
+
+    async def connect(self, handler):
+        self._handler = handler
+
+    async def publish(self, event):
+        self._handler(event)
+
+    async def close(self):
+        self._handler = None
+
+
+# Bus shared between processes through a Broker listening on a Unix socket.
+class BrokerBus:
+    processes = None
+
+    def __init__(self, path, retry=1.0):
+        self.path = path
+        self.retry = retry
+        self._handler = None
+        self._reader = None
+        self._writer = None
+        self._task = None
+        # Joins published by this process and not yet parted, re-announced if
+        # the broker goes away and comes back.
+        self._local = collections.Counter()
+
+    async def connect(self, handler):
+        self._handler = handler
+        await self._open()
+        self._task = asyncio.create_task(self._listen())
+
+    async def _open(self):
+        self._reader, self._writer = await asyncio.open_unix_connection(self.path, limit=MAX_LINE)
+        self._handler({'type': 'reset'})
+        for (channel, username), count in self._local.items():
+            for _ in range(count):
+                self._writer.write(_encode({'type': 'join', 'channel': channel, 'username': username}))
+
+    async def _listen(self):
+        while True:
+            try:
+                while line := await self._reader.readline():
+                    self._handler(json.loads(line))
+            except ConnectionError:
+                pass
+            except Exception:
+                # Whatever it was, events may have been lost: start over with
+                # a fresh connection and presence snapshot.
+                log.exception("chat bus listener failed, reconnecting")
+            self._writer.close()
+            while True:
+                await asyncio.sleep(self.retry)
+                try:
+                    await self._open()
+                except OSError:
+                    continue
+                break
+
+    async def publish(self, event):
+        kind = event['type']
+        if kind == 'join':
+            self._local[_presence_key(event)] += 1
+        elif kind == 'part':
+            key = _presence_key(event)
+            self._local[key] -= 1
+            if self._local[key] <= 0:
+                del self._local[key]
+        if self._writer.is_closing():
+            return
+        if len(line := _encode(event)) > MAX_LINE:
+            log.warning("dropped a %d byte %s event, the bus limit is %d", len(line), kind, MAX_LINE)
+            return
+        self._writer.write(line)
+        try:
+            await self._writer.drain()
+        except ConnectionError:
+            pass
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+        if self._writer is not None:
+            self._writer.close()
+
+
+# Relays every event to every connected worker and keeps the presence table,
+# so a worker that connects late gets the current joins and a worker that dies
+# has its users parted on its behalf.
+class Broker:
+    def __init__(self, path, high_water=1 << 20):
+        self.path = path
+        self.high_water = high_water
+        self._clients = {}
+        self._server = None
+
+    async def start(self):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._handle, path=self.path, limit=MAX_LINE)
+        return self._server
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for writer in list(self._clients):
+            writer.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.path)
+
+    async def _handle(self, reader, writer):
+        for other in self._clients.values():
+            for (channel, username), count in other.items():
+                for _ in range(count):
+                    writer.write(_encode({'type': 'join', 'channel': channel, 'username': username}))
+        presence = self._clients[writer] = collections.Counter()
+        try:
+            while line := await reader.readline():
+                event = json.loads(line)
+                kind = event['type']
+                if kind == 'join':
+                    presence[_presence_key(event)] += 1
+                elif kind == 'part':
+                    key = _presence_key(event)
+                    presence[key] -= 1
+                    if presence[key] <= 0:
+                        del presence[key]
+                self._publish(line)
+        except ConnectionError:
+            pass
+        except Exception:
+            # A worker sending lines too long or not JSON is dropped, and
+            # parted, like one that went away.
+            log.exception("dropping chat bus client")
+        finally:
+            del self._clients[writer]
+            writer.close()
+            for (channel, username), count in presence.items():
+                for _ in range(count):
+                    self._publish(_encode({'type': 'part', 'channel': channel, 'username': username}))
+
+    def _publish(self, line):
+        for writer in list(self._clients):
+            # A worker that stops reading is cut loose rather than buffered
+            # forever; it reconnects and gets a fresh presence snapshot.
+            if writer.transport.get_write_buffer_size() > self.high_water:
+                writer.close()
+                continue
+            writer.write(line)
+
+
+async def run_broker(path):
+    broker = Broker(path)
+    server = await broker.start()
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await broker.close()
+
+
+if __name__ == '__main__':
+    import sys
+    try:
+        asyncio.run(run_broker(sys.argv[1] if len(sys.argv) > 1 else 'bbs-chat.sock'))
+    except KeyboardInterrupt:
+        pass
@@ -1,41 +1,289 @@
 import asyncio
+import collections
+import enum
+import itertools
+import sys
+import time
 
 from colorama import Fore, Back, Style
 
-class Chat:
+from bbs import metrics
+from bbs.bus import LocalBus
+from bbs.chatlog import ChatLogWriter
+from bbs.connections import get_connections
+from bbs.presence import ONLINE, get_presence
+
+_events = metrics.Counter('bbs_chat_events_total', "Chat bus events handled", ['type'])
+_fanout_seconds = metrics.Histogram(
+    'bbs_chat_fanout_seconds', "Time to queue one message for every member of its channel",
+    buckets=(0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05),
+)
+_outbox_overflows = metrics.Counter('bbs_chat_outbox_overflows_total', "Messages that found an outbox full")
+
+class Overflow(enum.Enum):
+    DROP_OLDEST = 'drop_oldest'
+    COALESCE = 'coalesce'
+    DISCONNECT = 'disconnect'
+
+# One line of channel history.  Usernames are interned, so a busy room holds
+# one copy of each name however many lines it has said.
+class ChatRecord:
+    __slots__ = ('time', 'username', 'text')
+
+    def __init__(self, time, username, text):
+        self.time = time
+        self.username = username
+        self.text = text
+
+    def __str__(self):
+        return f"{Style.DIM}[{time.strftime('%H:%M', time.localtime(self.time))}]{Style.RESET_ALL} {self.text}"
+
+# One channel's history: the latest lines that fit both the line and the
+# byte limit, though never fewer than the last one.
+class HistoryRing:
+    __slots__ = ('records', 'size')
+
     def __init__(self):
-        self._users = {}
+        self.records = collections.deque()
+        self.size = 0
 
-    def names(self):
-        return list(user.username for user in self._users.keys())
+    def __len__(self):
+        return len(self.records)
 
-    async def send(self, message):
-        for recipient, client in self._users.items():
-            await client.recv(message)
+    def append(self, record, max_lines, max_bytes):
+        self.records.append(record)
+        self.size += len(record.text.encode('utf8'))
+        while len(self.records) > 1 and (len(self.records) > max_lines or self.size > max_bytes):
+            self.size -= len(self.records.popleft().text.encode('utf8'))
+
+class Chat:
+    DEFAULT_CHANNEL = '#lobby'
+    # Channels whose history is kept; the least recently active go first.
+    HISTORY_CHANNELS = 256
+
+    def __init__(
+        self, queue_size=64, overflow=Overflow.DROP_OLDEST, history_size=200, history_bytes=64 << 10, replay=20,
+        presence=None,
+    ):
+        self._clients = set()
+        # channel -> member clients (each client knows its own channels).
+        # Fan-out and /names only ever touch the one channel they are about.
+        self._channels = {}
+        # channel -> Counter of usernames and username -> Counter of channels,
+        # across every process on the bus.
+        self._presence = {}
+        self._user_channels = {}
+        self._bus = LocalBus(self._dispatch)
+        # Logged-in sessions share the chat bus for their presence and
+        # private messages.
+        self.presence = presence or get_presence()
+        self.presence.attach(self.publish)
+        # channel -> HistoryRing of the last ChatRecords, at most history_size
+        # of them and history_bytes of text, fed from the bus so every
+        # process has the whole room's history.
+        self._history = collections.OrderedDict()
+        self.queue_size = queue_size
+        self.overflow = Overflow(overflow)
+        self.history_size = history_size
+        self.history_bytes = history_bytes
+        self.replay = replay
+        self.log = None
+
+    async def use_bus(self, bus):
+        await bus.connect(self._dispatch)
+        old, self._bus = self._bus, bus
+        await old.close()
+
+    async def publish(self, event):
+        await self._bus.publish(event)
+
+    @property
+    def processes(self):
+        # How many processes share the bus, or None when it cannot tell.
+        return self._bus.processes
+
+    async def close(self):
+        await self._bus.close()
+        if self.log is not None:
+            await self.log.close()
+
+    def _dispatch(self, event):
+        kind = event['type']
+        _events.labels(kind).inc()
+        if kind == 'message':
+            if event.get('username'):
+                self._remember(event)
+            with _fanout_seconds.time():
+                for client in self._channels.get(event['channel'], ()):
+                    client.recv(event['text'])
+        elif kind == 'broadcast':
+            for client in self._clients:
+                client.recv(event['text'])
+        elif kind == 'direct' or event.get('channel') == ONLINE:
+            self.presence.dispatch(event)
+        elif kind in ('sessions', 'kick', 'sessions_reply'):
+            get_connections().dispatch(event, self.publish)
+        elif kind == 'join':
+            channel, username = event['channel'], event['username']
+            self._presence.setdefault(channel, collections.Counter())[username] += 1
+            self._user_channels.setdefault(username, collections.Counter())[channel] += 1
+        elif kind == 'part':
+            channel, username = event['channel'], event['username']
+            _decrement(self._presence, channel, username)
+            _decrement(self._user_channels, username, channel)
+        elif kind == 'reset':
+            self._presence.clear()
+            self._user_channels.clear()
+            self.presence.dispatch(event)
+
+    def _remember(self, event):
+        channel = event['channel']
+        ring = self._history.get(channel)
+        if ring is None:
+            ring = self._history[channel] = HistoryRing()
+            if len(self._history) > self.HISTORY_CHANNELS:
+                self._history.popitem(last=False)
+        else:
+            self._history.move_to_end(channel)
+        ring.append(
+            ChatRecord(event.get('time', time.time()), sys.intern(event['username']), event['text']),
+            self.history_size, self.history_bytes,
+        )
+
+    def history(self, channel, count=None):
+        ring = self._history.get(channel)
+        if ring is None:
+            return []
+        if count is None or count >= len(ring):
+            return list(ring.records)
+        return list(itertools.islice(ring.records, len(ring) - count, None))
+
+    @staticmethod
+    def channel_name(name):
+        name = name.strip().lower()
+        if not name.startswith('#'):
+            name = '#' + name
+        return name
+
+    def names(self, channel=DEFAULT_CHANNEL):
+        return list(self._presence.get(channel, ()))
+
+    def channels(self):
+        return [(name, len(present)) for name, present in self._presence.items()]
+
+    def user_channels(self, username):
+        return sorted(self._user_channels.get(username, ()))
+
+    async def join(self, client, channel):
+        members = self._channels.setdefault(channel, set())
+        if client in members:
+            return
+        members.add(client)
+        client.channels.add(channel)
+        # Leave room in the outbox for the join notice and live traffic.
+        for record in self.history(channel, min(self.replay, self.queue_size // 2)):
+            client.recv(str(record))
+        await self._bus.publish({'type': 'join', 'channel': channel, 'username': client.user.username})
+        await self.system_message(f"{client.user.username} has joined {channel}", channel)
+
+    async def part(self, client, channel):
+        members = self._channels.get(channel)
+        if members is None or client not in members:
+            return
+        await self.system_message(f"{client.user.username} has left {channel}", channel)
+        members.discard(client)
+        if not members:
+            del self._channels[channel]
+        client.channels.discard(channel)
+        await self._bus.publish({'type': 'part', 'channel': channel, 'username': client.user.username})
+
+    async def send(self, message, channel=DEFAULT_CHANNEL, username=None):
+        # Delivery happens in _dispatch once the bus hands the event back.  Each
+        # recipient has its own outbox drained by its own task, so fan-out is
+        # one enqueue per local client and a stalled connection only ever holds
+        # up itself.  Only lines said by a user (username set) go into history
+        # and the log; the log is written by the process the line came from.
+        event = {'type': 'message', 'channel': channel, 'text': message}
+        if username is not None:
+            event['username'] = username
+            event['time'] = time.time()
+            if self.log is not None:
+                self.log.append(ChatRecord(event['time'], username, message), channel)
+        await self._bus.publish(event)
+
+    async def broadcast(self, message):
+        await self._bus.publish({'type': 'broadcast', 'text': message})
 
     async def connect(self, user, reader, writer):
         if not user.can_chat and not user.is_admin:
             return 'You are banned from chat.'
-        await self.system_message(f"{user.username} has joined chat")
-        self._users[user] = client = ChatClient(self, user, reader, writer)
-        await client.chat()
-        self._users.pop(user)
-        await self.system_message(f"{user.username} has left chat")
+        client = ChatClient(
+            self, user, reader, writer,
+            queue_size=self.queue_size, overflow=self.overflow,
+        )
+        self._clients.add(client)
+        try:
+            await client.chat()
+        finally:
+            for channel in list(client.channels):
+                await self.part(client, channel)
+            self._clients.discard(client)
         return 'Goodbye.'
 
-    async def system_message(self, message):
-        await self.send(f"{Fore.RED}{Style.DIM}*** {message}{Style.RESET_ALL}")
+    async def system_message(self, message, channel=None):
+        message = f"{Fore.RED}{Style.DIM}*** {message}{Style.RESET_ALL}"
+        if channel is None:
+            await self.broadcast(message)
+        else:
+            await self.send(message, channel)
+
+def _decrement(index, key, member):
+    counts = index.get(key)
+    if counts is None:
+        return
+    counts[member] -= 1
+    if counts[member] <= 0:
+        del counts[member]
+    if not counts:
+        del index[key]
 
 class ChatClient:
-    def __init__(self, server, user, reader, writer):
+    __slots__ = (
+        'server', 'user', 'reader', 'writer', 'queue_size', 'overflow', 'skipped',
+        'closed', 'channel', 'channels', '_outbox', '_pending',
+    )
+
+    def __init__(self, server, user, reader, writer, queue_size=64, overflow=Overflow.DROP_OLDEST):
         self.server = server
         self.user = user
         self.reader = reader
         self.writer = writer
-    
+        self.queue_size = queue_size
+        self.overflow = Overflow(overflow)
+        self.skipped = 0
+        self.closed = False
+        self.channel = server.DEFAULT_CHANNEL
+        self.channels = set()
+        self._outbox = collections.deque()
+        self._pending = asyncio.Event()
+
     async def chat(self):
-        prompt = 'chat> '
-        self.writer.write(prompt)
+        outbox = asyncio.create_task(self._drain_outbox())
+        # Private messages show up in the room while we are here.
+        session = self.server.presence.session(self.user.username, self.writer)
+        if session is not None:
+            session.where, session.handler = 'chat', self.recv
+        try:
+            await self._chat()
+        finally:
+            self.closed = True
+            outbox.cancel()
+            if session is not None:
+                session.where, session.handler = 'menu', None
+
+    async def _chat(self):
+        await self.server.join(self, self.channel)
+        self.writer.write(self.prompt)
         while True:
             line = await self.reader.readline()
             if line is self.reader.BREAK:
@@ -55,16 +303,72 @@ class ChatClient:
                     await self.print_error("You do not have permission for that command")
                 line = ''
             elif line.startswith('/names'):
-                names = self.server.names()
-                await self.print_info("Users currently in chat:")
-                for name in names:
+                _, _, channel = line.partition(' ')
+                channel = self.server.channel_name(channel) if channel.strip() else self.channel
+                await self.print_info(f"Users currently in {channel}:")
+                for name in self.server.names(channel):
                     await self.print_info(f"  {name}")
                 line = ''
+            elif line.startswith('/join '):
+                _, _, channel = line.partition(' ')
+                if channel.strip():
+                    self.channel = self.server.channel_name(channel)
+                    await self.server.join(self, self.channel)
+                line = ''
+            elif line.startswith('/part'):
+                _, _, channel = line.partition(' ')
+                channel = self.server.channel_name(channel) if channel.strip() else self.channel
+                await self.server.part(self, channel)
+                if channel == self.channel:
+                    self.channel = next(iter(self.channels), None)
+                line = ''
+            elif line.startswith('/history'):
+                _, _, count = line.partition(' ')
+                count = int(count) if count.strip().isdigit() else self.server.replay
+                if self.channel is not None:
+                    for record in self.server.history(self.channel, min(count, self.queue_size)):
+                        await self.print(str(record))
+                line = ''
+            elif line.startswith('/msg '):
+                _, _, remainder = line.partition(' ')
+                target, _, text = remainder.strip().partition(' ')
+                if not text.strip():
+                    await self.print_error("Usage: /msg USER TEXT")
+                elif await self.server.presence.message(
+                    self.user.username, target,
+                    f"{Fore.MAGENTA}*{self.user.username}* {text}{Style.RESET_ALL}",
+                ):
+                    await self.print(f"{Fore.MAGENTA}-> *{target}* {text}{Style.RESET_ALL}")
+                else:
+                    await self.print_error(f"{target} is not online")
+                line = ''
+            elif line.startswith('/whois '):
+                _, _, target = line.partition(' ')
+                target = target.strip()
+                if not self.server.presence.is_online(target):
+                    await self.print_error(f"{target} is not online")
+                else:
+                    channels = ', '.join(self.server.user_channels(target)) or 'no channels'
+                    sessions = self.server.presence.count(target)
+                    await self.print_info(f"{target} is online ({sessions} session{'s' if sessions != 1 else ''}), in {channels}")
+                line = ''
+            elif line.startswith('/list'):
+                await self.print_info("Channels:")
+                for name, count in self.server.channels():
+                    await self.print_info(f"  {name:<20} {count}")
+                line = ''
             elif line.strip():
                 line = f"<{self.user.username}> {line}"
             if line.strip():
-                await self.send(line)
-            self.writer.write('\r\x1b[2K' + prompt)
+                if self.channel is None:
+                    await self.print_error("You are not in any channel, /join one first")
+                else:
+                    await self.send(f"{Style.DIM}{self.channel}{Style.RESET_ALL} {line}")
+            self.writer.write('\r\x1b[2K' + self.prompt)
+
+    @property
+    def prompt(self):
+        return f'{self.channel or "chat"}> '
 
     async def print_error(self, message):
         await self.print(f"{Fore.RED}{Style.DIM}!!! {message}{Style.RESET_ALL}")
@@ -73,16 +377,61 @@ class ChatClient:
         await self.print(f"{Fore.BLUE}** {message}{Style.RESET_ALL}")
 
     async def send(self, message):
-        await self.server.send(message)
+        await self.server.send(message, self.channel, self.user.username)
 
     async def print(self, message):
+        self.recv(message)
+
+    def recv(self, message):
+        if self.closed:
+            return
+        if len(self._outbox) >= self.queue_size:
+            _outbox_overflows.inc()
+            if self.overflow is Overflow.DISCONNECT:
+                self.disconnect()
+                return
+            self._outbox.popleft()
+            if self.overflow is Overflow.COALESCE:
+                self.skipped += 1
+        self._outbox.append(message)
+        self._pending.set()
+
+    def disconnect(self):
+        # Closing the connection makes the pending readline return BREAK, which
+        # takes the client out of the room through the normal exit path.
+        self.closed = True
+        self._outbox.clear()
+        self.writer.close()
+
+    def _write(self, message):
         self.writer.write(f'\x1b7\n\x1b[1A\x1b[1L{message}\x1b8')
 
-    async def recv(self, message):
-        await self.print(message)
+    async def _drain_outbox(self):
+        while True:
+            await self._pending.wait()
+            self._pending.clear()
+            if self.skipped:
+                self._write(f"{Fore.RED}{Style.DIM}*** {self.skipped} messages skipped{Style.RESET_ALL}")
+                self.skipped = 0
+            while self._outbox:
+                self._write(self._outbox.popleft())
+            try:
+                await self.writer.drain()
+            except ConnectionError:
+                return
 
 
 
 _chat = Chat()
 def get_chat():
-    return _chat
\ No newline at end of file
+    return _chat
+
+def configure_chat(history_size=None, replay=None, log=False, history_bytes=None):
+    if history_size is not None:
+        _chat.history_size = history_size
+    if history_bytes is not None:
+        _chat.history_bytes = history_bytes
+    if replay is not None:
+        _chat.replay = replay
+    if log:
+        _chat.log = ChatLogWriter()
\ No newline at end of file
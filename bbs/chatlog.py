@@ -0,0 +1,63 @@
+import asyncio
+import collections
+import contextlib
+import datetime
+import logging
+
+from bbs.models import ChatLog
+
+log = logging.getLogger(__name__)
+
+
+# Persistent chat log.  Chat.send only appends to a bounded queue; a
+# background task writes whatever has piled up with one bulk_create per batch,
+# so the database is never on the message path.  If the database falls far
+# enough behind, the oldest unwritten lines are dropped (and counted).
+class ChatLogWriter:
+    def __init__(self, batch_size=200, interval=1.0, maxsize=10000):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.dropped = 0
+        self.written = 0
+        self._queue = collections.deque(maxlen=maxsize)
+        self._task = None
+
+    def append(self, record, channel):
+        if len(self._queue) == self._queue.maxlen:
+            self.dropped += 1
+        self._queue.append((record, channel))
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self):
+        while self._queue:
+            count = min(self.batch_size, len(self._queue))
+            batch = [self._queue.popleft() for _ in range(count)]
+            try:
+                await ChatLog.bulk_create([
+                    ChatLog(
+                        channel=channel,
+                        username=record.username,
+                        text=record.text,
+                        created=datetime.datetime.fromtimestamp(record.time),
+                    )
+                    for record, channel in batch
+                ])
+            except Exception:
+                log.exception("could not write %d chat log lines", count)
+                self.dropped += count
+            else:
+                self.written += count
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        await self.flush()
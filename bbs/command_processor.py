@@ -1,13 +1,77 @@
+import bisect
+import os
+import posixpath
 import shlex
+import time
 
 from colorama import Fore, Back, Style
 
+from bbs import metrics, search
 from bbs.chat import get_chat
+from bbs.connections import get_connections
+from bbs.models import ContentType, Document, StaleWrite, normalize_path
+from bbs.presence import get_presence
+from bbs.watchdog import get_watchdog
 
 class Exit(BaseException):
     pass
 
+def command(*aliases, usage='', exact=False):
+    # Extra names and an argument spec for a do_* method.  Arguments written
+    # <like this> in usage are required; dispatch answers with the usage line
+    # instead of calling the command when they are missing.  exact commands
+    # (the ones that end a session or a menu) are never matched by an
+    # abbreviation, so a stray keystroke cannot run them.
+    def decorate(func):
+        func.aliases = aliases
+        func.usage = usage
+        func.exact = exact
+        return func
+    return decorate
+
+class Command:
+    # Upper bounds, in seconds, of the latency histogram buckets.
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0, float('inf'))
+
+    __slots__ = (
+        'name', 'attr', 'aliases', 'usage', 'required', 'exact', 'doc', 'calls', 'errors', 'total', 'histogram',
+    )
+
+    def __init__(self, name, func):
+        self.name = name
+        self.attr = func.__name__
+        self.aliases = getattr(func, 'aliases', ())
+        self.usage = getattr(func, 'usage', '')
+        self.required = sum(arg.startswith('<') for arg in self.usage.split())
+        self.exact = getattr(func, 'exact', False)
+        self.doc = (func.__doc__ or '').strip()
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+        self.histogram = [0] * len(self.BUCKETS)
+
+    def observe(self, elapsed, failed=False):
+        self.calls += 1
+        self.errors += failed
+        self.total += elapsed
+        self.histogram[bisect.bisect_left(self.BUCKETS, elapsed)] += 1
+
+    def percentile(self, fraction):
+        # The upper bound of the bucket holding that fraction of the calls.
+        wanted = fraction * self.calls
+        seen = 0
+        for bound, count in zip(self.BUCKETS, self.histogram):
+            seen += count
+            if count and seen >= wanted:
+                return bound
+        return 0.0
+
 class BaseProcessor:
+    # Every processor class, for the admin stats command.
+    processors = []
+
+    __slots__ = ('_user', '_reader', '_writer', '_prompt')
+
     def __init__(self, user, reader, writer, prompt='>>> '):
         self._user = user
         self._reader = reader
@@ -23,9 +87,51 @@ class BaseProcessor:
         self._writer.write(prompt)
 
     def writeline(self, line=''):
-        line = line.rstrip('\r\n')
-        self._writer.write(line)
-        self._writer.write('\r\n')
+        self._writer.write(line.rstrip('\r\n') + '\r\n')
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._build_commands()
+
+    @classmethod
+    def _build_commands(cls):
+        # Done once per class: the command table, every name and alias, every
+        # unambiguous abbreviation of them, and the help text.
+        cls.commands = {
+            attr[3:]: Command(attr[3:], getattr(cls, attr))
+            for attr in dir(cls)
+            if attr.startswith('do_')
+        }
+        cls._names = {}
+        for command in cls.commands.values():
+            for name in (command.name, *command.aliases):
+                cls._names[name] = command
+        candidates = {}
+        for name, command in cls._names.items():
+            if command.exact:
+                continue
+            for end in range(1, len(name)):
+                candidates.setdefault(name[:end], set()).add(command)
+        cls._prefixes = {
+            prefix: commands.pop() if len(commands) == 1 else None
+            for prefix, commands in candidates.items()
+            if prefix not in cls._names
+        }
+        width = max(len(f"{c.name} {c.usage}") for c in cls.commands.values()) + 2
+        cls.help_text = f"{Fore.BLUE}Available Commands:\r\n" + '\r\n'.join(
+            f"  {f'{c.name} {c.usage}':<{width}} {c.doc}"
+            + (f" (also: {', '.join(c.aliases)})" if c.aliases else '')
+            for c in cls.commands.values()
+        ) + Style.RESET_ALL
+        BaseProcessor.processors.append(cls)
+
+    @classmethod
+    def find_command(cls, name):
+        # An exact name or alias, else a unique abbreviation.  None for an
+        # ambiguous abbreviation, and a KeyError for no match at all.
+        if name in cls._names:
+            return cls._names[name]
+        return cls._prefixes[name]
 
     def parseline(self, line):
         line = line.strip()
@@ -36,26 +142,42 @@ class BaseProcessor:
         return "Unknown command."
 
     async def dispatch(self, line):
-        cmd, args = self.parseline(line)
-        func = getattr(self, f'do_{cmd}', self.default)
-        return await func(*args)
+        try:
+            cmd, args = self.parseline(line)
+        except ValueError as exc:
+            return f"Could not parse arguments: {exc}"
+        try:
+            command = self.find_command(cmd)
+        except KeyError:
+            return await self.default(cmd, *args)
+        if command is None:
+            matches = sorted(
+                name for name, command in self._names.items()
+                if name.startswith(cmd) and not command.exact
+            )
+            return f"Ambiguous command: {cmd} ({', '.join(matches)})"
+        if len(args) < command.required:
+            return f"Usage: {command.name} {command.usage}"
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = await getattr(self, command.attr)(*args)
+            failed = False
+            return result
+        except Exit:
+            failed = False
+            raise
+        finally:
+            command.observe(time.perf_counter() - started, failed)
 
+    @command('?')
     async def do_help(self, *args):
         """
         Print this help
         """
-        commands = [
-            (c[3:], getattr(self, c).__doc__.strip())
-            for c in dir(self.__class__)
-            if c.startswith('do_')
-        ]
-        body = '\r\n'.join(
-            f"  {cmd:<12} {doc}"
-            for cmd, doc
-            in commands
-        )
-        return (f"{Fore.BLUE}Available Commands:\r\n{body}{Style.RESET_ALL}")
+        return self.help_text
 
+    @command('quit', exact=True)
     async def do_exit(self, *args):
         """
         Exit this menu
@@ -79,9 +201,145 @@ class BaseProcessor:
                 )
             except Exit:
                 break
+            # A client that types commands but never reads their output
+            # stops being served here instead of filling memory.
+            await self._writer.throttle()
         return 'Goodbye.'
 
+BaseProcessor._build_commands()
+
 class MainProcessor(BaseProcessor):
+    __slots__ = ('_cwd',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cwd = None
+
+    async def cwd(self):
+        if self._cwd is None:
+            home = await Document.resolve_id(self._user.home_id)
+            self._cwd = home.path if home is not None else '/'
+        return self._cwd
+
+    async def do_pwd(self, *args):
+        """
+        Print the current directory
+        """
+        return await self.cwd()
+
+    @command(usage='[path]')
+    async def do_cd(self, path=None, *args):
+        """
+        Change directory (home if no path is given)
+        """
+        if path is None:
+            self._cwd = None
+            return await self.cwd()
+        node = await Document.resolve(path, await self.cwd())
+        if node is None:
+            return f"{path}: No such directory"
+        if not node.is_directory:
+            return f"{path}: Not a directory"
+        self._cwd = node.path
+        return node.path
+
+    @command('dir', usage='[path]')
+    async def do_ls(self, path='.', *args):
+        """
+        List a directory
+        """
+        children = await Document.listdir(path, await self.cwd())
+        if children is None:
+            return f"{path}: No such directory"
+        return '\r\n'.join(
+            f"{child.segment}/" if child.is_directory else child.segment
+            for child in children
+        )
+
+    @command('type', usage='<path>')
+    async def do_cat(self, path, *args):
+        """
+        Print a text document
+        """
+        node = await Document.resolve(path, await self.cwd())
+        if node is None:
+            return f"{path}: No such document"
+        if node.is_directory:
+            return f"{path}: Is a directory"
+        document = await node.fetch()
+        # One chunk at a time, waiting for the connection to take each before
+        # loading the next, so a large document never sits in memory whole.
+        async for chunk in document.open_read():
+            self._writer.write(chunk.replace('\n', '\r\n'))
+            await self._writer.drain()
+        return ''
+
+    @command(usage='<path>')
+    async def do_post(self, path, *args):
+        """
+        Write a text document, ending with a line holding only "."
+        """
+        target = normalize_path(path, await self.cwd())
+        home = await Document.resolve_id(self._user.home_id)
+        if not self._user.is_admin and (home is None or not (target + '/').startswith(home.path + '/')):
+            return f"{path}: Permission denied"
+        node = await Document.resolve(target)
+        if node is not None and node.is_directory:
+            return f"{path}: Is a directory"
+        parent = await Document.resolve(posixpath.dirname(target))
+        if parent is None or not parent.is_directory:
+            return f"{path}: No such directory"
+        if node is None:
+            document = await Document.make(
+                posixpath.basename(target), await parent.fetch(), content_type=ContentType.text,
+            )
+        else:
+            document = await node.fetch()
+        self.writeline('Enter text, end with a line holding only "."')
+        try:
+            async with document.open_write() as out:
+                while True:
+                    line = await self._reader.readline()
+                    if line is self._reader.BREAK:
+                        raise Exit
+                    self.writeline()
+                    if line == '.':
+                        break
+                    await out.write(line + '\n')
+        except StaleWrite:
+            return f"{document.path} was changed by someone else while you wrote; your text was not saved"
+        return f"Saved {document.path}"
+
+    @command(usage='[-p PAGE] <words>...')
+    async def do_search(self, *args):
+        """
+        Search documents
+        """
+        page = 1
+        if len(args) > 1 and args[0] == '-p' and args[1].isdigit():
+            page, args = int(args[1]), args[2:]
+        if not args:
+            return f"Usage: search {self.commands['search'].usage}"
+        hits = await search.search(' '.join(args), page)
+        if not hits:
+            return "No matches."
+        return '\r\n'.join(
+            f"{hit['path']}\r\n    {' '.join(hit['snippet'].split())}"
+            for hit in hits
+        )
+
+    async def do_who(self, *args):
+        """
+        List who is online
+        """
+        presence = get_presence()
+        names = presence.online()
+        body = '\r\n'.join(
+            f"  {name:<20} {presence.count(name)} session{'s' if presence.count(name) != 1 else ''}"
+            for name in names
+        )
+        return f"{len(names)} online:\r\n{body}"
+
     async def do_chat(self, *args):
         """
         Enter text chat
@@ -95,6 +353,8 @@ class MainProcessor(BaseProcessor):
         return await AdminProcessor(self._user, self._reader, self._writer).process()
 
 class AdminProcessor(BaseProcessor):
+    __slots__ = ()
+
     async def allowed(self):
         return self._user.is_admin
 
@@ -102,4 +362,130 @@ class AdminProcessor(BaseProcessor):
         """
         Do something admin-like, that hasn't been made yet
         """
-        return "NOT IMPLEMENTED"
\ No newline at end of file
+        return "NOT IMPLEMENTED"
+
+    @command(usage='[after]')
+    async def do_reindex(self, *args):
+        """
+        Rebuild the search index (optionally after a document id)
+        """
+        after = int(args[0]) if args and args[0].isdigit() else 0
+        last = await search.reindex(after=after)
+        return f"Search index rebuilt up to document {last}"
+
+    async def do_stats(self, *args):
+        """
+        Show command counts and latencies
+        """
+        lines = [f"{'command':<24} {'calls':>7} {'errors':>6} {'mean':>9} {'p50':>7} {'p99':>7}"]
+        for processor in BaseProcessor.processors:
+            for c in processor.commands.values():
+                if not c.calls:
+                    continue
+                lines.append(
+                    f"{processor.__name__ + '.' + c.name:<24} {c.calls:>7} {c.errors:>6} "
+                    f"{c.total / c.calls * 1000:>7.1f}ms {_bound(c.percentile(0.5)):>7} {_bound(c.percentile(0.99)):>7}"
+                )
+        return '\r\n'.join(lines)
+
+    @command(usage='[prefix]')
+    async def do_metrics(self, prefix='', *args):
+        """
+        Show runtime metrics, optionally only those starting with prefix
+        """
+        return metrics.render(prefix).rstrip('\n').replace('\n', '\r\n')
+
+    @command(usage='[n]')
+    async def do_stalls(self, n=None, *args):
+        """
+        Show where the event loop stalled most, or the stack of offender n
+        """
+        watchdog = get_watchdog()
+        if watchdog is None:
+            return "The stall watchdog is not running."
+        top = watchdog.top()
+        if n is not None:
+            if not n.isdigit() or not 1 <= int(n) <= len(top):
+                return f"No offender {n}."
+            offender = top[int(n) - 1]
+            return f"{offender.where}, worst {offender.worst * 1000:.0f}ms:\r\n" + (
+                offender.stack.rstrip('\n').replace('\n', '\r\n') or "(not sampled)"
+            )
+        lines = [
+            f"{watchdog.stalls} stalls over {watchdog.threshold * 1000:g}ms",
+            f"{'#':>3} {'stalls':>6} {'total':>9} {'worst':>9}  where",
+        ]
+        for i, offender in enumerate(top, 1):
+            lines.append(
+                f"{i:>3} {offender.count:>6} {offender.total * 1000:>7.0f}ms {offender.worst * 1000:>7.0f}ms  {offender.where}"
+            )
+        return '\r\n'.join(lines)
+
+    async def do_sessions(self, *args):
+        """
+        List the connections to every server process
+        """
+        chat = get_chat()
+        rows = await get_connections().ask(chat.publish, {'type': 'sessions'}, chat.processes)
+        rows.sort(key=lambda row: [int(part) for part in row['id'].split('.')])
+        lines = [
+            f"{len(rows)} connections",
+            f"{'id':>12} {'user':<16} {'from':<21} {'where':<10} {'age':>7} {'idle':>7} {'in':>8} {'out':>9} {'held':>7}",
+        ]
+        for row in rows:
+            lines.append(
+                f"{row['id']:>12} {row['user'] or '-':<16} {row['peer']:<21} {row['where']:<10} "
+                f"{_duration(row['age']):>7} {_duration(row['idle']):>7} "
+                f"{row['in']:>8} {row['out']:>9} {row['held']:>7}"
+            )
+        return '\r\n'.join(lines)
+
+    @command(usage='<id>', exact=True)
+    async def do_kick(self, id, *args):
+        """
+        Disconnect a session by its id from 'sessions'
+        """
+        # A bare number is a session of this process.
+        session = id if '.' in id else f'{os.getpid()}.{id}'
+        connection = get_connections().find(session)
+        if connection is not None and connection.stream is self._writer:
+            return "That is you."
+        chat = get_chat()
+        rows = await get_connections().ask(chat.publish, {'type': 'kick', 'session': session}, 1)
+        if not rows:
+            return f"No session {id}."
+        return f"Disconnected session {rows[0]['id']} ({rows[0]['user'] or 'not logged in'})."
+
+def _duration(seconds):
+    seconds = int(seconds)
+    if seconds < 3600:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds // 3600}h{seconds // 60 % 60:02d}m"
+
+def _bound(seconds):
+    if seconds == float('inf'):
+        return 'slow'
+    return f"<{seconds * 1000:g}ms"
+
+def _command_seconds():
+    # The per-command numbers dispatch already keeps, exported as they are.
+    lines = metrics.family_header('bbs_command_seconds', "Command latency", 'histogram')
+    for processor in BaseProcessor.processors:
+        for c in processor.commands.values():
+            if c.calls:
+                lines.extend(metrics.histogram_lines(
+                    'bbs_command_seconds', ('processor', 'command'), (processor.__name__, c.name),
+                    c.BUCKETS, c.histogram, c.total, c.calls,
+                ))
+    return lines
+
+def _command_errors():
+    lines = metrics.family_header('bbs_command_errors_total', "Commands that raised", 'counter')
+    for processor in BaseProcessor.processors:
+        for c in processor.commands.values():
+            if c.errors:
+                lines.append(f'bbs_command_errors_total{{processor="{processor.__name__}",command="{c.name}"}} {c.errors}')
+    return lines
+
+metrics.REGISTRY.add_collector('bbs_command_seconds', _command_seconds)
+metrics.REGISTRY.add_collector('bbs_command_errors_total', _command_errors)
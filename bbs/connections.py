@@ -0,0 +1,256 @@
+import asyncio
+import contextlib
+import itertools
+import math
+import os
+import time
+
+from bbs import metrics
+from bbs.presence import get_presence
+
+_reaped = metrics.Counter('bbs_sessions_reaped_total', "Sessions closed by the reaper or an admin", ['reason'])
+_refused = metrics.Counter('bbs_sessions_refused_total', "Connections turned away at the session cap")
+
+
+# A hashed timer wheel: slots of items, one slot per resolution seconds,
+# and a cursor that advances one slot per tick.  Scheduling and cancelling
+# are set operations, and a tick only touches the items that fell due.
+# Delays past the end of the wheel land in its last slot; whoever takes them
+# out is expected to check and schedule them again.
+class TimerWheel:
+    def __init__(self, resolution=1.0, slots=512):
+        self.resolution = resolution
+        self._slots = [set() for _ in range(slots)]
+        self._where = {}
+        self._cursor = 0
+
+    def __len__(self):
+        return len(self._where)
+
+    def schedule(self, item, delay):
+        self.cancel(item)
+        ticks = min(max(1, math.ceil(delay / self.resolution)), len(self._slots) - 1)
+        index = (self._cursor + ticks) % len(self._slots)
+        self._slots[index].add(item)
+        self._where[item] = index
+
+    def cancel(self, item):
+        index = self._where.pop(item, None)
+        if index is not None:
+            self._slots[index].discard(item)
+
+    def advance(self):
+        self._cursor = (self._cursor + 1) % len(self._slots)
+        due, self._slots[self._cursor] = self._slots[self._cursor], set()
+        for item in due:
+            del self._where[item]
+        return due
+
+
+# One telnet connection, from accept to hang-up, whether or not anyone has
+# logged in on it yet.  The byte counts and idle time are read from its
+# Readline when asked for.
+class Connection:
+    __slots__ = ('id', 'stream', 'peer', 'started', 'username')
+
+    def __init__(self, id, stream):
+        self.id = id
+        self.stream = stream
+        host, port, *_ = stream.get_extra_info('peername') or ('?', 0)
+        self.peer = f'{host}:{port}'
+        self.started = time.monotonic()
+        self.username = None
+
+    @property
+    def idle(self):
+        return time.monotonic() - self.stream.last_input
+
+    def close(self, message):
+        if not self.stream.is_closing():
+            self.stream.write(f'\r\n{message}\r\n')
+            self.stream.close()
+
+
+# The answers gathered for one ConnectionManager.ask.
+class _Request:
+    __slots__ = ('rows', 'processes', 'answered', 'done')
+
+    def __init__(self, processes):
+        self.rows = []
+        self.processes = processes
+        self.answered = 0
+        self.done = asyncio.Event()
+
+
+class ConnectionManager:
+    # Every open connection in this process.  Idle ones are found by a
+    # single timer wheel: each connection sits in the slot for the moment
+    # it would time out had it been idle since it was last looked at, and
+    # reading input never touches the wheel.  When the slot comes round the
+    # connection is closed if it really has been idle that long, and moved
+    # along to its new deadline otherwise.
+    #
+    # Admins list and kick sessions of every process on the chat bus, where
+    # a session is known as '<pid>.<id>':
+    #   {'type': 'sessions', 'reply': ...}
+    #   {'type': 'kick', 'session': ..., 'reply': ...}
+    # are answered, by every process and by the one holding the session
+    # respectively, with one or more
+    #   {'type': 'sessions_reply', 'to': ..., 'data': [...], 'last': bool}
+    REPLY_PAGE = 500
+
+    def __init__(self, idle_timeout=1800.0, login_timeout=120.0, max_sessions=None, resolution=1.0):
+        self.idle_timeout = idle_timeout
+        self.login_timeout = login_timeout
+        self.max_sessions = max_sessions
+        self._connections = {}
+        self._ids = itertools.count(1)
+        self._wheel = TimerWheel(resolution)
+        self._task = None
+        self._requests = itertools.count(1)
+        self._replies = {}
+        self._answering = set()
+
+    def __len__(self):
+        return len(self._connections)
+
+    def __iter__(self):
+        return iter(list(self._connections.values()))
+
+    def get(self, id):
+        return self._connections.get(id)
+
+    @staticmethod
+    def session_id(connection):
+        # The pid is looked up each time: the manager is made before workers fork.
+        return f'{os.getpid()}.{connection.id}'
+
+    def find(self, session_id):
+        # A connection of this process, by its session id or its bare id.
+        pid, _, id = session_id.rpartition('.')
+        if pid and pid != str(os.getpid()) or not id.isdigit():
+            return None
+        return self._connections.get(int(id))
+
+    def describe(self):
+        presence = get_presence()
+        now = time.monotonic()
+        rows = []
+        for c in self._connections.values():
+            session = c.username and presence.session(c.username, c.stream)
+            rows.append({
+                'id': self.session_id(c), 'user': c.username, 'peer': c.peer,
+                'where': session.where if session else 'login',
+                'age': now - c.started, 'idle': c.idle,
+                'in': c.stream.received, 'out': c.stream.sent, 'held': c.stream.buffered(),
+            })
+        return rows
+
+    async def ask(self, publish, event, processes=None, timeout=1.0):
+        # Publishes a request and returns the rows that come back, once
+        # `processes` processes have answered in full or, when how many will
+        # answer is not known, after timeout.
+        token = f'{os.getpid()}.{next(self._requests)}'
+        request = self._replies[token] = _Request(processes)
+        try:
+            await publish(dict(event, reply=token))
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(request.done.wait(), timeout)
+            return request.rows
+        finally:
+            del self._replies[token]
+
+    def dispatch(self, event, publish):
+        kind = event['type']
+        if kind == 'sessions':
+            rows = self.describe()
+            for start in range(0, len(rows), self.REPLY_PAGE):
+                self._answer(publish, event['reply'], rows[start:start + self.REPLY_PAGE], False)
+            self._answer(publish, event['reply'], [], True)
+        elif kind == 'kick':
+            if (connection := self.find(event['session'])) is not None:
+                self.kick(connection)
+                row = {'id': self.session_id(connection), 'user': connection.username}
+                self._answer(publish, event['reply'], [row], True)
+        elif kind == 'sessions_reply' and (request := self._replies.get(event['to'])) is not None:
+            request.rows.extend(event['data'])
+            if event['last']:
+                request.answered += 1
+                if request.answered == request.processes:
+                    request.done.set()
+
+    def _answer(self, publish, token, rows, last):
+        # Called from the bus handler, which cannot wait for the send.
+        task = asyncio.create_task(publish({'type': 'sessions_reply', 'to': token, 'data': rows, 'last': last}))
+        self._answering.add(task)
+        task.add_done_callback(self._answering.discard)
+
+    def timeout(self, connection):
+        # Until someone logs in, an idle connection is given much less rope.
+        if connection.username is None:
+            return min(filter(None, (self.login_timeout, self.idle_timeout)), default=0)
+        return self.idle_timeout
+
+    def add(self, stream):
+        # None when the server is full; the caller says so and hangs up.
+        if self.max_sessions and len(self._connections) >= self.max_sessions:
+            _refused.inc()
+            return None
+        connection = Connection(next(self._ids), stream)
+        self._connections[connection.id] = connection
+        self._schedule(connection, self.timeout(connection))
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return connection
+
+    def remove(self, connection):
+        self._connections.pop(connection.id, None)
+        self._wheel.cancel(connection)
+
+    def login(self, connection, username):
+        connection.username = username
+        self._schedule(connection, self.timeout(connection) - connection.idle)
+
+    def kick(self, connection, reason='kicked', message="You have been disconnected."):
+        _reaped.labels(reason).inc()
+        self._wheel.cancel(connection)
+        connection.close(message)
+
+    def _schedule(self, connection, delay):
+        if self.timeout(connection):
+            self._wheel.schedule(connection, delay)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self._wheel.resolution)
+            for connection in self._wheel.advance():
+                if connection.id not in self._connections:
+                    continue
+                timeout = self.timeout(connection)
+                if not timeout:
+                    continue
+                if (remaining := timeout - connection.idle) <= 0:
+                    self.kick(connection, 'idle', "Idle too long, goodbye.")
+                else:
+                    self._schedule(connection, remaining)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+
+_connections = ConnectionManager()
+
+
+def configure_connections(idle_timeout=1800.0, login_timeout=120.0, max_sessions=None):
+    # A timeout of 0 turns that check off.
+    global _connections
+    _connections = ConnectionManager(idle_timeout, login_timeout, max_sessions)
+    return _connections
+
+
+def get_connections():
+    return _connections
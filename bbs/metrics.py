@@ -0,0 +1,266 @@
+import asyncio
+import bisect
+import contextlib
+import logging
+import time
+
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+# Process-local counters, gauges and histograms, rendered in the Prometheus
+# text format for the /metrics endpoint and the admin 'metrics' command.
+# Updating one is an attribute bump (plus a bisect for histograms), cheap
+# enough to leave on everywhere; labelled children are created on first use
+# and cached.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Duplicate metric {metric.name}")
+        self._metrics[metric.name] = metric
+
+    def add_collector(self, name, collector):
+        # A callable returning the exposition lines of metric family name,
+        # for numbers that are already kept somewhere else.
+        self._collectors.append((name, collector))
+
+    def render(self, prefix=''):
+        lines = []
+        for name, metric in self._metrics.items():
+            if name.startswith(prefix):
+                lines.extend(metric.collect())
+        for name, collector in self._collectors:
+            if name.startswith(prefix):
+                lines.extend(collector())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        if not self.labelnames:
+            self._default = self.labels()
+        registry.register(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._child()
+        return child
+
+    def collect(self):
+        yield from family_header(self.name, self.help, self.kind)
+        for values, child in list(self._children.items()):
+            yield from child.lines(self.name, _labels(self.labelnames, values), self.labelnames, values)
+
+
+class _Value:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def lines(self, name, labels, labelnames, values):
+        yield f"{name}{labels} {_number(self.value)}"
+
+
+class Counter(_Metric):
+    kind = 'counter'
+    _child = _Value
+
+    def inc(self, amount=1):
+        self._default.value += amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+    _child = _Value
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY, fn=None):
+        # With fn the value is read when rendered instead of being set.
+        self._fn = fn
+        super().__init__(name, help, labelnames, registry)
+
+    def set(self, value):
+        self._default.value = value
+
+    def inc(self, amount=1):
+        self._default.value += amount
+
+    def dec(self, amount=1):
+        self._default.value -= amount
+
+    def collect(self):
+        if self._fn is not None:
+            self._default.value = self._fn()
+        yield from super().collect()
+
+
+class _Timer:
+    __slots__ = ('_histogram', '_start')
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._start)
+
+
+class _HistogramValue:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+    def lines(self, name, labels, labelnames, values):
+        yield from histogram_lines(
+            name, labelnames, values, (*self.bounds, float('inf')), self.counts, self.sum, self.count,
+        )
+
+
+def histogram_lines(name, labelnames, values, bounds, counts, total, count):
+    # bounds end with +Inf and counts are per bucket, not cumulative.
+    cumulative = 0
+    for bound, n in zip(bounds, counts):
+        cumulative += n
+        le = 'le="' + _number(bound) + '"'
+        yield f"{name}_bucket{_labels(labelnames, values, le)} {cumulative}"
+    labels = _labels(labelnames, values)
+    yield f"{name}_sum{labels} {_number(total)}"
+    yield f"{name}_count{labels} {count}"
+
+
+def family_header(name, help, kind):
+    return [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, labelnames, registry)
+
+    def _child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def time(self):
+        return _Timer(self._default)
+
+
+def render(prefix=''):
+    return REGISTRY.render(prefix)
+
+
+loop_lag = Gauge('bbs_loop_lag_seconds', "How late the last event loop check woke up")
+loop_lag_histogram = Histogram('bbs_loop_lag_check_seconds', "Event loop lag per check")
+
+
+async def watch_loop(interval=0.5):
+    loop = asyncio.get_running_loop()
+    while True:
+        before = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - before - interval)
+        loop_lag.set(lag)
+        loop_lag_histogram.observe(lag)
+
+
+_watcher = None
+_runner = None
+
+
+async def start_metrics(port=None, host='127.0.0.1', interval=0.5, sock=None):
+    # The loop watcher always runs; the HTTP endpoint only with a port or a
+    # listening socket (inherited from the pre-fork supervisor).
+    global _watcher, _runner
+    if _watcher is None:
+        _watcher = asyncio.create_task(watch_loop(interval))
+    if (port is not None or sock is not None) and _runner is None:
+        async def handle(request):
+            return web.Response(
+                body=render().encode('utf8'),
+                headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'},
+            )
+
+        app = web.Application()
+        app.router.add_get('/metrics', handle)
+        _runner = web.AppRunner(app, access_log=None)
+        await _runner.setup()
+        if sock is not None:
+            await web.SockSite(_runner, sock).start()
+            host, port, *_ = sock.getsockname()
+        else:
+            await web.TCPSite(_runner, host, port).start()
+        log.info("metrics on http://%s:%d/metrics", host, port)
+
+
+async def stop_metrics():
+    global _watcher, _runner
+    if _watcher is not None:
+        _watcher.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await _watcher
+        _watcher = None
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
@@ -1,10 +1,59 @@
 from enum import IntEnum
+import asyncio
+import collections
+import csv
+import copy
+import itertools
+import logging
+import os
 import pathlib
+import posixpath
+import sys
+import time
+import weakref
 
 from tortoise.models import Model
 from tortoise import fields, Tortoise, run_async
+from tortoise.backends.base.config_generator import expand_db_url
+from tortoise.exceptions import IntegrityError, OperationalError
+from tortoise.transactions import in_transaction
+from tortoise.utils import generate_schema_for_client
 
-from bbs.security import PASSWORD_CONTEXT
+from bbs import metrics, search
+from bbs.cache import TTLCache
+from bbs.security import PASSWORD_CONTEXT, ahash, averify
+
+log = logging.getLogger(__name__)
+
+_db_seconds = metrics.Histogram('bbs_db_seconds', "Time spent in database calls", ['call'])
+_user_lookups = metrics.Counter('bbs_user_lookups_total', "User lookups, by cache outcome", ['result'])
+
+DEFAULT_DB_URL = 'sqlite://test.db'
+SQLITE_ENGINE = 'tortoise.backends.sqlite'
+# Applied to every SQLite connection unless the URL's query string says
+# otherwise, e.g. sqlite://bbs.db?synchronous=FULL&mmap_size=0.  WAL lets the
+# read connections below run while a write is in progress, and busy_timeout
+# makes a writer wait out a competing one instead of failing.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -16384,
+    'mmap_size': 1 << 28,
+    'busy_timeout': 5000,
+    'temp_store': 'MEMORY',
+}
+
+_db_url = os.environ.get('BBS_DB_URL', DEFAULT_DB_URL)
+_read_connections = 2
+_read_pool = None
+
+# Recently loaded users and recently looked-up names that do not exist, so a
+# burst of logins does not turn into a burst of queries.  _live_users holds
+# the UserInfo of everyone still logged in, so every session of a user shares
+# one however long ago each of them logged in.
+_user_cache = TTLCache(maxsize=4096, ttl=300)
+_missing_users = TTLCache(maxsize=16384, ttl=60)
+_live_users = weakref.WeakValueDictionary()
 
 
 class ContentType(IntEnum):
@@ -26,30 +75,397 @@ class Document(Model):
     # owner: fields.ForeignKeyNullableRelation["User"] = fields.ForeignKeyField(
     #     "models.User", related_name="documents", null=True
     # )
-    content = fields.TextField(null=True)
+    # Content lives in DocumentChunk rows, read and written as a stream with
+    # open_read() and open_write().  version says which generation of chunks
+    # is current, so a rewrite only replaces the old content once it is done.
+    version = fields.IntField(default=0)
+    chunks: fields.ReverseRelation["DocumentChunk"]
+    # Materialized absolute path ('/users/alice'), so resolving a path, the
+    # path of a document and a whole subtree are each one indexed query.  It
+    # is kept up to date by make(), move() and remove(); create documents
+    # through those rather than with create().
+    path = fields.CharField(max_length=1024, unique=True)
+
+    @staticmethod
+    def join_path(parent_path, segment):
+        return str(pathlib.PurePosixPath(parent_path, segment))
+
+    def _subtree_range(self):
+        # Every descendant path sorts in (prefix, prefix with its trailing
+        # '/' bumped to '0'), which an index can answer as a range scan.
+        prefix = self.path.rstrip('/') + '/'
+        return prefix, prefix[:-1] + '0'
 
     async def full_path(self):
-        segments = []
-        obj = self
-        while obj.segment != self.ROOT:
-            segments.append(obj.segment)
-            obj = await obj.parent
-        return pathlib.PurePosixPath('/', *reversed(segments))
+        return pathlib.PurePosixPath(self.path)
+
+    @staticmethod
+    def check_segment(segment):
+        if not segment or segment in ('.', '..') or '/' in segment:
+            raise ValueError(f"invalid document name {segment!r}")
+
+    @classmethod
+    async def make(cls, segment, parent=None, **kwargs):
+        if parent is not None:
+            cls.check_segment(segment)
+        path = '/' if parent is None else cls.join_path(parent.path, segment)
+        document = await cls.create(segment=segment, parent=parent, path=path, **kwargs)
+        _tree.add(document)
+        return document
+
+    @classmethod
+    async def resolve(cls, path, cwd='/'):
+        return await _tree.get(normalize_path(path, cwd))
+
+    @classmethod
+    async def resolve_id(cls, id):
+        return await _tree.get_id(id)
+
+    @classmethod
+    async def listdir(cls, path, cwd='/'):
+        node = await cls.resolve(path, cwd)
+        if node is None:
+            return None
+        return sorted(node.children.values(), key=lambda child: child.segment)
+
+    @classmethod
+    async def get_path(cls, path):
+        return await cls.filter(path=str(pathlib.PurePosixPath('/', path))).first()
+
+    async def subtree(self):
+        low, high = self._subtree_range()
+        return await Document.filter(path__gt=low, path__lt=high).order_by('path')
+
+    async def move(self, parent, segment=None):
+        segment = segment or self.segment
+        self.check_segment(segment)
+        with _db_seconds.labels('move').time():
+            async with in_transaction('default') as connection:
+                # Either instance may predate another move, so the guard
+                # goes by the paths as they are inside this transaction.
+                paths = dict(await Document.filter(id__in=[self.id, parent.id]).using_db(connection).values_list(
+                    'id', 'path',
+                ))
+                if self.id not in paths or parent.id not in paths:
+                    raise ValueError(f"{self.path} or {parent.path} no longer exists")
+                self.path = old_path = paths[self.id]
+                parent.path = parent_path = paths[parent.id]
+                new_path = self.join_path(parent_path, segment)
+                low, high = self._subtree_range()
+                if parent_path == old_path or low <= parent_path < high:
+                    raise ValueError(f"cannot move {old_path} into itself")
+                # One statement rewrites every descendant's path prefix, in
+                # the quoting, placeholders and concatenation of the backend.
+                executor = connection.executor_class(model=Document, db=connection)
+                new, start, after, before = (executor.parameter(i).get_sql() for i in range(4))
+                quote = connection.query_class._builder().QUOTE_CHAR
+                table, path = f'{quote}{self._meta.db_table}{quote}', f'{quote}path{quote}'
+                suffix = f'SUBSTR({path}, {start})'
+                if connection.capabilities.dialect == 'mysql':
+                    value = f'CONCAT({new}, {suffix})'
+                else:
+                    value = f'{new} || {suffix}'
+                await connection.execute_query(
+                    f'UPDATE {table} SET {path} = {value} WHERE {path} > {after} AND {path} < {before}',
+                    [new_path, len(old_path) + 1, low, high],
+                )
+                await Document.filter(id=self.id).using_db(connection).update(
+                    parent_id=parent.id, segment=segment, path=new_path,
+                )
+                self.parent = parent
+                self.segment = segment
+                self.path = new_path
+        _tree.move(old_path, self)
+
+    async def remove(self):
+        low, high = self._subtree_range()
+        with _db_seconds.labels('remove').time():
+            async with in_transaction('default') as connection:
+                await search.unindex_subtree(self.id, low, high, connection)
+                await Document.filter(path__gt=low, path__lt=high).using_db(connection).delete()
+                await self.delete(using_db=connection)
+        _tree.discard(self.path)
+
+    async def open_read(self, page=16):
+        # The version current when reading starts is registered in _reading,
+        # so a write committed meanwhile leaves its chunks alone.
+        key = (self.id, self.version)
+        _reading[key] += 1
+        try:
+            seq = 0
+            while True:
+                with _db_seconds.labels('read_chunks').time():
+                    chunks = await DocumentChunk.filter(
+                        document_id=self.id, version=key[1], seq__gte=seq,
+                    ).order_by('seq').limit(page).values_list('data', flat=True)
+                for data in chunks:
+                    yield data
+                if len(chunks) < page:
+                    return
+                seq += page
+        finally:
+            _reading[key] -= 1
+            if not _reading[key]:
+                del _reading[key]
+
+    def open_write(self):
+        return DocumentWriter(self)
 
     @classmethod
     async def get_root(cls):
-        return await cls.get(segment=cls.ROOT)
+        return await cls.get(path='/')
 
     @classmethod
     async def get_users(cls):
-        return await cls.get(segment=cls.USERS)
+        return await cls.get(path=f'/{cls.USERS}')
 
     @classmethod
     async def create_roots(cls):
-        root = await cls.create(segment=cls.ROOT)
-        users = await cls.create(segment=cls.USERS, parent=root)
-        await root.save()
-        await users.save()
+        root = await cls.make(cls.ROOT)
+        await cls.make(cls.USERS, root)
+
+class DocumentChunk(Model):
+    id = fields.IntField(pk=True)
+    document: fields.ForeignKeyRelation[Document] = fields.ForeignKeyField(
+        "models.Document", on_delete=fields.CASCADE, related_name="chunks"
+    )
+    version = fields.IntField()
+    seq = fields.IntField()
+    data = fields.TextField()
+
+    class Meta:
+        unique_together = (('document', 'version', 'seq'),)
+
+# (document id, version) -> open_read calls streaming it in this process.
+_reading = collections.Counter()
+
+class StaleWrite(Exception):
+    pass
+
+class DocumentWriter:
+    # Each write claims a version number of its own by inserting a marker
+    # chunk at seq -1; the unique (document, version, seq) constraint makes
+    # a concurrent claim of the same number fail and try the next one, in
+    # this process or any other.  Of two overlapping writes the one that
+    # claimed the later version wins: the other finds it committed and
+    # raises StaleWrite.  A commit keeps the version it replaces, for
+    # readers in other processes, and any version still being read here.
+    CHUNK_SIZE = 4096
+    CLAIM = -1
+
+    def __init__(self, document):
+        self.document = document
+        self.version = None
+        self._buffer = []
+        self._buffered = 0
+        self._seq = 0
+
+    async def __aenter__(self):
+        self.version = await self._claim()
+        return self
+
+    async def _claim(self):
+        while True:
+            latest = await DocumentChunk.filter(document_id=self.document.id).order_by('-version').limit(1).values_list(
+                'version', flat=True,
+            )
+            version = max([self.document.version, *latest]) + 1
+            try:
+                await DocumentChunk.create(document_id=self.document.id, version=version, seq=self.CLAIM, data='')
+            except IntegrityError:
+                continue
+            return version
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.close()
+        else:
+            await DocumentChunk.filter(document_id=self.document.id, version=self.version).delete()
+
+    async def write(self, text):
+        self._buffer.append(text)
+        self._buffered += len(text)
+        if self._buffered >= self.CHUNK_SIZE:
+            await self._flush()
+
+    async def _flush(self, final=False):
+        data = ''.join(self._buffer)
+        self._buffer.clear()
+        chunks = []
+        while len(data) >= self.CHUNK_SIZE or (final and data):
+            size = self.CHUNK_SIZE
+            if len(data) > size:
+                # Break on whitespace so words are never split across chunks.
+                size = max(data.rfind(' ', 0, size), data.rfind('\n', 0, size)) + 1 or size
+            chunks.append(DocumentChunk(
+                document_id=self.document.id, version=self.version, seq=self._seq, data=data[:size],
+            ))
+            self._seq += 1
+            data = data[size:]
+        if data:
+            self._buffer.append(data)
+        self._buffered = len(data)
+        if chunks:
+            with _db_seconds.labels('write_chunks').time():
+                await DocumentChunk.bulk_create(chunks)
+
+    async def close(self):
+        await self._flush(final=True)
+        committed = False
+        with _db_seconds.labels('commit_version').time():
+            async with in_transaction('default') as connection:
+                current, = await Document.filter(id=self.document.id).using_db(connection).values_list(
+                    'version', flat=True,
+                )
+                if current < self.version:
+                    await Document.filter(id=self.document.id).using_db(connection).update(version=self.version)
+                    self.document.version = self.version
+                    await DocumentChunk.filter(
+                        document_id=self.document.id, version=self.version, seq=self.CLAIM,
+                    ).using_db(connection).delete()
+                    await search.index_version(self.document.id, self.version, connection)
+                    reading = [version for id, version in _reading if id == self.document.id]
+                    await DocumentChunk.filter(
+                        document_id=self.document.id, version__lt=current, version__not_in=reading,
+                    ).using_db(connection).delete()
+                    committed = True
+        if not committed:
+            await DocumentChunk.filter(document_id=self.document.id, version=self.version).delete()
+            raise StaleWrite(f"{self.document.path} was rewritten while this write was in progress")
+
+def normalize_path(path, cwd='/'):
+    path = posixpath.normpath(posixpath.join('/', cwd, path))
+    # normpath keeps a leading '//', which POSIX allows to mean something else.
+    return '/' + path.lstrip('/')
+
+class DocumentNode:
+    __slots__ = ('id', 'parent_id', 'segment', 'content_type', 'path', 'children')
+
+    def __init__(self, id, parent_id, segment, content_type, path):
+        self.id = id
+        self.parent_id = parent_id
+        self.segment = segment
+        self.content_type = ContentType(content_type)
+        self.path = path
+        self.children = {}
+
+    @property
+    def is_directory(self):
+        return self.content_type == ContentType.directory
+
+    async def fetch(self):
+        return await Document.get(id=self.id)
+
+class DocumentTree:
+    # Write-through cache of the document skeleton (no content), so path
+    # resolution and directory listings never touch the database.  Mutations
+    # made through Document update it in place.  Other processes sharing the
+    # database can change the tree behind our back, so it is also reloaded
+    # once it is older than max_age seconds.  An id it has never seen means
+    # the snapshot is stale (ids come from the database): that one row is
+    # looked up directly and the whole tree is reloaded on next use.
+    def __init__(self, max_age=30.0):
+        self.max_age = max_age
+        self._by_path = None
+        self._by_id = None
+        self._loaded = 0.0
+        self._lock = None
+
+    async def _ensure(self):
+        if self._by_path is not None and time.monotonic() - self._loaded < self.max_age:
+            return
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._by_path is None or time.monotonic() - self._loaded >= self.max_age:
+                await self.load()
+
+    async def load(self):
+        with _db_seconds.labels('load_tree').time():
+            rows = await Document.all().using_db(read_connection()).values('id', 'parent_id', 'segment', 'content_type', 'path')
+        by_id = {row['id']: DocumentNode(**row) for row in rows}
+        for node in by_id.values():
+            parent = by_id.get(node.parent_id)
+            if parent is not None:
+                parent.children[node.segment] = node
+        self._by_id = by_id
+        self._by_path = {node.path: node for node in by_id.values()}
+        self._loaded = time.monotonic()
+
+    def invalidate(self):
+        self._by_path = self._by_id = None
+
+    async def get(self, path):
+        await self._ensure()
+        return self._by_path.get(path)
+
+    async def get_id(self, id):
+        await self._ensure()
+        if (node := self._by_id.get(id)) is not None:
+            return node
+        with _db_seconds.labels('get_node').time():
+            rows = await Document.filter(id=id).using_db(read_connection()).values(
+                'id', 'parent_id', 'segment', 'content_type', 'path',
+            )
+        if not rows:
+            return None
+        self._loaded = 0.0
+        return DocumentNode(**rows[0])
+
+    def add(self, document):
+        if self._by_path is None:
+            return
+        node = DocumentNode(
+            document.id, document.parent_id, document.segment,
+            document.content_type, document.path,
+        )
+        self._by_id[node.id] = node
+        self._by_path[node.path] = node
+        parent = self._by_id.get(node.parent_id)
+        if parent is not None:
+            parent.children[node.segment] = node
+
+    def discard(self, path):
+        if self._by_path is None:
+            return
+        node = self._by_path.get(path)
+        if node is None:
+            return
+        parent = self._by_id.get(node.parent_id)
+        if parent is not None:
+            parent.children.pop(node.segment, None)
+        for gone in self._walk(node):
+            self._by_id.pop(gone.id, None)
+            self._by_path.pop(gone.path, None)
+
+    def move(self, old_path, document):
+        if self._by_path is None:
+            return
+        node = self._by_path.get(old_path)
+        if node is None:
+            self.invalidate()
+            return
+        old_parent = self._by_id.get(node.parent_id)
+        if old_parent is not None:
+            old_parent.children.pop(node.segment, None)
+        node.parent_id = document.parent_id
+        node.segment = document.segment
+        new_parent = self._by_id.get(node.parent_id)
+        if new_parent is not None:
+            new_parent.children[node.segment] = node
+        for moved in self._walk(node):
+            self._by_path.pop(moved.path, None)
+            moved.path = document.path + moved.path[len(old_path):]
+            self._by_path[moved.path] = moved
+
+    def _walk(self, node):
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(node.children.values())
+
+_tree = DocumentTree()
 
 class User(Model):
     id = fields.IntField(pk=True)
@@ -66,63 +482,412 @@ class User(Model):
 
     @classmethod
     async def new_user(cls, username, password, email, can_chat, is_admin):
-        password = PASSWORD_CONTEXT.hash(password)
-        user = await cls.create(
-            username=username,
-            password=password,
-            email=email,
-            can_chat=can_chat,
-            is_admin=is_admin,
-        )
+        password = await ahash(password)
         user_root = await Document.get_users()
-        user_dir = await Document.create(
-            segment=user.username,
-            parent=user_root,
-        )
-        user.home = user_dir
-        user_dir.owner = user
-        await user_dir.save()
-        await user.save()
+        with _db_seconds.labels('new_user').time():
+            async with in_transaction('default'):
+                user_dir = await Document.make(username, user_root)
+                user = await cls.create(
+                    username=username,
+                    password=password,
+                    email=email,
+                    can_chat=can_chat,
+                    is_admin=is_admin,
+                    home=user_dir,
+                )
+        _forget_user(username)
+        _share_user(UserInfo.from_model(user))
         return user
 
+    @classmethod
+    async def bulk_new_users(cls, rows, batch_size=500, report=None):
+        # rows are dicts with new_user's arguments.  Rows that cannot be
+        # created (a bad name, a name already taken or seen earlier in rows)
+        # are skipped before their password is hashed, and listed in report.
+        # Passwords for the next batch are hashed on the executor while the
+        # current one is inserted.  Each batch is its own transaction, so a
+        # long import never holds the database's write lock for its whole
+        # run; one that stops part way can simply be run again, as whatever
+        # it already created is skipped the second time.
+        report = report if report is not None else ImportReport()
+        user_root = await Document.get_users()
+        rows = iter(rows)
+        batches = iter(lambda: list(itertools.islice(rows, batch_size)), [])
+        seen = set()
+
+        async def hashed(batch):
+            if batch is None:
+                return None, None
+            batch = await cls._vet_batch(user_root, batch, seen, report)
+            return batch, await asyncio.gather(*(ahash(row['password']) for row in batch))
+
+        pending = asyncio.ensure_future(hashed(next(batches, None)))
+        try:
+            while True:
+                batch, passwords = await pending
+                if batch is None:
+                    break
+                pending = asyncio.ensure_future(hashed(next(batches, None)))
+                if batch:
+                    await cls._insert_batch(user_root, batch, passwords)
+                    report.created += len(batch)
+        finally:
+            pending.cancel()
+            _tree.invalidate()
+        return report.created
+
+    @classmethod
+    async def _vet_batch(cls, user_root, batch, seen, report):
+        valid = []
+        for row in batch:
+            username = row['username']
+            try:
+                Document.check_segment(username)
+            except ValueError as exc:
+                report.skipped.append((username, str(exc)))
+                continue
+            if username in seen:
+                report.skipped.append((username, "listed more than once"))
+                continue
+            seen.add(username)
+            valid.append(row)
+        if not valid:
+            return valid
+        names = [row['username'] for row in valid]
+        taken = set(await cls.filter(username__in=names).values_list('username', flat=True))
+        homes = set(await Document.filter(
+            path__in=[Document.join_path(user_root.path, name) for name in names],
+        ).values_list('segment', flat=True))
+        for row in valid:
+            if row['username'] in taken:
+                report.skipped.append((row['username'], "user already exists"))
+            elif row['username'] in homes:
+                report.skipped.append((row['username'], "home directory already exists"))
+        return [row for row in valid if row['username'] not in taken and row['username'] not in homes]
+
+    @classmethod
+    async def _insert_batch(cls, user_root, batch, passwords):
+        async with in_transaction('default') as connection:
+            await Document.bulk_create([
+                Document(
+                    segment=row['username'],
+                    parent_id=user_root.id,
+                    path=Document.join_path(user_root.path, row['username']),
+                )
+                for row in batch
+            ], using_db=connection)
+            # bulk_create does not report ids, so look the new homes up by path.
+            homes = dict(await Document.filter(
+                path__in=[Document.join_path(user_root.path, row['username']) for row in batch],
+            ).using_db(connection).values_list('segment', 'id'))
+            await cls.bulk_create([
+                cls(
+                    username=row['username'],
+                    password=password,
+                    email=row['email'],
+                    can_chat=row['can_chat'],
+                    is_admin=row['is_admin'],
+                    home_id=homes[row['username']],
+                )
+                for row, password in zip(batch, passwords)
+            ], using_db=connection)
+        for row in batch:
+            _forget_user(row['username'])
+
     @classmethod
     async def get_user(cls, username):
-        user = await cls.filter(username=username).first()
-        return user
+        # A UserInfo shared with every other session of the same user.
+        user = _user_cache.get(username)
+        if user is not None or username in _missing_users:
+            _user_lookups.labels('cached').inc()
+            return user
+        _user_lookups.labels('query').inc()
+        with _db_seconds.labels('get_user').time():
+            row = await cls.filter(username=username).using_db(read_connection()).values_list(
+                *UserInfo.FIELDS,
+            )
+        if not row:
+            _missing_users.set(username, True)
+            return None
+        return _share_user(UserInfo(*row[0]))
+
+    async def save(self, *args, **kwargs):
+        await super().save(*args, **kwargs)
+        _forget_user(self.username)
+
+    async def delete(self, *args, **kwargs):
+        await super().delete(*args, **kwargs)
+        _forget_user(self.username)
 
     def verify(self, password):
         return PASSWORD_CONTEXT.verify(password, self.password)
 
+    async def averify(self, password):
+        return await averify(password, self.password)
+
     def __repr__(self):
         return f"<{self.__class__.__name__}({self.username=}, password=..., {self.email=}, {self.is_admin=}, {self.can_chat=})>"
 
     def __str__(self):
         return self.username
 
+# What a session needs to know about its user, without a model instance
+# (and its __dict__, field metadata and relation caches) per connection.
+class UserInfo:
+    FIELDS = ('id', 'username', 'password', 'is_admin', 'can_chat', 'home_id')
+    __slots__ = FIELDS + ('__weakref__',)
+
+    def __init__(self, id, username, password, is_admin, can_chat, home_id):
+        self.id = id
+        self.username = sys.intern(username)
+        self.password = password
+        self.is_admin = is_admin
+        self.can_chat = can_chat
+        self.home_id = home_id
+
+    @classmethod
+    def from_model(cls, user):
+        return cls(*(getattr(user, name) for name in cls.FIELDS))
+
+    def verify(self, password):
+        return PASSWORD_CONTEXT.verify(password, self.password)
+
+    async def averify(self, password):
+        return await averify(password, self.password)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}({self.username=}, password=..., {self.is_admin=}, {self.can_chat=})>"
+
+    def __str__(self):
+        return self.username
+
+def _forget_user(username):
+    # The next get_user goes to the database, and refreshes live sessions'
+    # copy from what it finds.  Other processes find out when their cached
+    # entry expires.
+    _user_cache.pop(username)
+    _missing_users.pop(username)
+
+def _share_user(info):
+    # A fresh load refreshes the copy live sessions already hold in place.
+    live = _live_users.get(info.username)
+    if live is None:
+        live = _live_users[info.username] = info
+    else:
+        for name in UserInfo.FIELDS:
+            setattr(live, name, getattr(info, name))
+    _user_cache.set(live.username, live)
+    return live
+
+class ChatLog(Model):
+    id = fields.BigIntField(pk=True)
+    channel = fields.CharField(max_length=255, index=True)
+    username = fields.CharField(max_length=255)
+    text = fields.TextField()
+    created = fields.DatetimeField(index=True)
+
+def configure_database(db_url=None, read_connections=None):
+    global _db_url, _read_connections
+    if db_url is not None:
+        _db_url = db_url
+    if read_connections is not None:
+        _read_connections = read_connections
+
+def db_config(db_url, read_connections=0):
+    # The 'default' connection takes every write.  For a SQLite file it is
+    # joined by read_connections query_only connections to the same file,
+    # each with its own sqlite handle and thread; server databases pool on
+    # their own and get none.
+    default = expand_db_url(db_url)
+    connections = {'default': default}
+    if default['engine'] == SQLITE_ENGINE:
+        default['credentials'] = {**SQLITE_PRAGMAS, **default['credentials']}
+        if default['credentials']['file_path'] != ':memory:':
+            for index in range(read_connections):
+                read = copy.deepcopy(default)
+                # The journal mode is a property of the file, set by the writer.
+                read['credentials'].pop('journal_mode', None)
+                read['credentials']['query_only'] = 'ON'
+                connections[f'read{index}'] = read
+    return {
+        'connections': connections,
+        'apps': {'models': {'models': [__name__], 'default_connection': 'default'}},
+    }
+
+def read_connection():
+    # Round-robin over the read-only connections, for queries that can live
+    # with not seeing this process's uncommitted writes.
+    if _read_pool is None:
+        return Tortoise.get_connection('default')
+    return Tortoise.get_connection(next(_read_pool))
+
+async def migrate_documents(connection):
+    # SQLite databases from before documents had a materialized path and
+    # chunked content: add path and version, fill path in from the parent
+    # chain, and move each document's content column into DocumentChunk
+    # rows, indexed for search.  Names the old schema allowed but paths
+    # cannot hold (a slash, '..', a sibling's name) get the id appended.
+    if connection.capabilities.dialect != 'sqlite':
+        return
+    columns = {row['name'] for row in await connection.execute_query_dict('PRAGMA table_info("document")')}
+    if not columns or 'path' in columns:
+        return
+    log.warning("migrating the document table to materialized paths and chunked content")
+    try:
+        async with in_transaction('default') as transaction:
+            await transaction.execute_query('ALTER TABLE "document" ADD COLUMN "version" INT NOT NULL DEFAULT 0')
+            await transaction.execute_query('ALTER TABLE "document" ADD COLUMN "path" VARCHAR(1024)')
+            rows = {
+                row['id']: row for row in await transaction.execute_query_dict(
+                    'SELECT "id", "segment", "parent_id", "content" FROM "document" ORDER BY "id"',
+                )
+            }
+            paths = {}
+            taken = set()
+
+            def path_of(id):
+                trail = []
+                while id is not None and id not in paths:
+                    if id in trail or id not in rows:
+                        raise RuntimeError(f"document {id} is not connected to the root: fix its parent_id and retry")
+                    trail.append(id)
+                    id = rows[id]['parent_id']
+                for id in reversed(trail):
+                    row = rows[id]
+                    if row['parent_id'] is None:
+                        if row['segment'] != Document.ROOT:
+                            raise RuntimeError(f"document {id} has no parent: fix its parent_id and retry")
+                        path = '/'
+                    else:
+                        segment = row['segment']
+                        path = Document.join_path(paths[row['parent_id']], segment)
+                        try:
+                            Document.check_segment(segment)
+                        except ValueError:
+                            path = None
+                        if path is None or path in taken:
+                            row['segment'] = f"{segment.replace('/', '_')}~{id}"
+                            path = Document.join_path(paths[row['parent_id']], row['segment'])
+                            log.warning("document %d renamed from %r to %r", id, segment, row['segment'])
+                    taken.add(path)
+                    paths[id] = path
+
+            for id in rows:
+                path_of(id)
+            await transaction.execute_many(
+                'UPDATE "document" SET "segment" = ?, "path" = ? WHERE "id" = ?',
+                [[rows[id]['segment'], path, id] for id, path in paths.items()],
+            )
+            await transaction.execute_query('CREATE UNIQUE INDEX "uid_document_path" ON "document" ("path")')
+            size = DocumentWriter.CHUNK_SIZE
+            for id, row in rows.items():
+                if not row['content']:
+                    continue
+                content = row['content']
+                await DocumentChunk.bulk_create([
+                    DocumentChunk(document_id=id, version=1, seq=seq, data=content[start:start + size])
+                    for seq, start in enumerate(range(0, len(content), size))
+                ], using_db=transaction)
+                await transaction.execute_query('UPDATE "document" SET "version" = 1 WHERE "id" = ?', [id])
+                await search.index_version(id, 1, transaction)
+            await transaction.execute_query('ALTER TABLE "document" DROP COLUMN "content"')
+    except OperationalError:
+        # Every worker runs this at startup.  The ALTER is the transaction's
+        # first statement, so only one of them migrates; the others fail here
+        # and are fine once it has committed, or crash and are respawned.
+        columns = {row['name'] for row in await connection.execute_query_dict('PRAGMA table_info("document")')}
+        if 'path' in columns:
+            return
+        raise
+    log.warning("migrated %d documents", len(rows))
+
 async def models_init(new=False):
-    db = await Tortoise.init(db_url='sqlite://test.db', modules={'models': [__name__]})
+    global _read_pool
+    config = db_config(_db_url, _read_connections)
+    db = await Tortoise.init(config=config)
+    readers = [name for name in config['connections'] if name != 'default']
+    _read_pool = itertools.cycle(readers) if readers else None
+    # An existing database still gets any tables added since it was made.
+    await generate_schema_for_client(Tortoise.get_connection('default'), safe=not new)
+    await search.search_init()
+    if not new:
+        await migrate_documents(Tortoise.get_connection('default'))
     if new:
-        await Tortoise.generate_schemas()
         await Document.create_roots()
         users = zip('admin user guest'.split(), [True, True, False], [True, False, False])
-        for username, can_chat, is_admin in users:
-            user = await User.new_user(
+        await User.bulk_new_users(
+            dict(
                 username=username,
                 password='password',
                 email=f'{username}@bbs.sdamon.com',
                 can_chat=can_chat,
                 is_admin=is_admin,
             )
+            for username, can_chat, is_admin in users
+        )
     return db
 
 async def models_cleanup():
+    global _read_pool
+    _read_pool = None
     await Tortoise.close_connections()
 
+def _flag(value):
+    return value.strip().lower() in ('1', 'true', 'yes', 'y')
+
+# What a bulk_new_users call got done.  It is filled in as the import goes,
+# so it is still right when the import stops with an error.
+class ImportReport:
+    __slots__ = ('created', 'skipped', 'error')
+
+    def __init__(self):
+        self.created = 0
+        self.skipped = []
+        self.error = None
+
+async def import_users(path, batch_size=500):
+    # CSV with a header row: username,password,email,can_chat,is_admin
+    report = ImportReport()
+    start = time.perf_counter()
+    try:
+        with open(path, newline='') as fp:
+            rows = (
+                dict(row, can_chat=_flag(row['can_chat'] or ''), is_admin=_flag(row['is_admin'] or ''))
+                for row in csv.DictReader(fp)
+            )
+            await User.bulk_new_users(rows, batch_size, report)
+    except Exception as exc:
+        report.error = exc
+    elapsed = time.perf_counter() - start
+    for username, reason in report.skipped:
+        print(f"Skipped {username!r}: {reason}")
+    count = report.created
+    print(f"Imported {count} users in {elapsed:.1f}s ({count / elapsed if elapsed else 0:.0f} users/s)")
+    if report.error is not None:
+        print(f"Import stopped: {type(report.error).__name__}: {report.error}")
+        print("Users imported so far are kept; running the import again skips them.")
+    return report
+
 if __name__ == '__main__':
-    import asyncio
-    async def newinit():
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m bbs.models')
+    parser.add_argument('--db', default=None, help=f"database URL (default: $BBS_DB_URL or {DEFAULT_DB_URL})")
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('init', help="create a fresh database (the default)")
+    importer = commands.add_parser('import', help="bulk-create users from a CSV file")
+    importer.add_argument('path')
+    importer.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+    configure_database(args.db)
+
+    async def run():
         try:
-            await models_init(True)
+            if args.command == 'import':
+                await models_init()
+                if (await import_users(args.path, args.batch_size)).error is not None:
+                    sys.exit(1)
+            else:
+                await models_init(True)
         finally:
             await models_cleanup()
-    asyncio.run(newinit())
\ No newline at end of file
+    asyncio.run(run())
\ No newline at end of file
@@ -0,0 +1,95 @@
+import collections
+import time
+
+# Who is logged in, as opposed to who is in a chat channel.  Every telnet
+# session registers here after login.  Sessions are announced on the chat bus
+# as joins and parts of the reserved ONLINE channel, so the broker's presence
+# bookkeeping (replay to late workers, parting a dead worker's users) covers
+# them too, and private messages travel as
+#   {'type': 'direct', 'to': ..., 'from': ..., 'text': ...}
+# to whichever process holds the recipient's sessions.
+ONLINE = '@online'
+
+
+class Session:
+    __slots__ = ('username', 'writer', 'since', 'where', 'handler')
+
+    def __init__(self, username, writer):
+        self.username = username
+        self.writer = writer
+        self.since = time.time()
+        self.where = 'menu'
+        # Set while something (the chat room) wants to show messages itself.
+        self.handler = None
+
+    def deliver(self, message):
+        if self.handler is not None:
+            self.handler(message)
+        elif not self.writer.is_closing():
+            self.writer.write(f'\x1b7\n\x1b[1A\x1b[1L{message}\x1b8')
+
+
+class Presence:
+    def __init__(self):
+        # username -> {writer: Session} for this process, and username ->
+        # session count across every process on the bus.
+        self._local = {}
+        self._online = collections.Counter()
+        self._publish = None
+
+    def attach(self, publish):
+        self._publish = publish
+
+    async def enter(self, username, writer):
+        session = Session(username, writer)
+        self._local.setdefault(username, {})[writer] = session
+        await self._publish({'type': 'join', 'channel': ONLINE, 'username': username})
+        return session
+
+    async def leave(self, session):
+        sessions = self._local.get(session.username)
+        if sessions is None or sessions.pop(session.writer, None) is None:
+            return
+        if not sessions:
+            del self._local[session.username]
+        await self._publish({'type': 'part', 'channel': ONLINE, 'username': session.username})
+
+    def session(self, username, writer):
+        return self._local.get(username, {}).get(writer)
+
+    def sessions(self, username):
+        return list(self._local.get(username, {}).values())
+
+    def is_online(self, username):
+        return username in self._online
+
+    def count(self, username):
+        return self._online[username]
+
+    def online(self):
+        return sorted(self._online)
+
+    async def message(self, sender, username, text):
+        if username not in self._online:
+            return False
+        await self._publish({'type': 'direct', 'to': username, 'from': sender, 'text': text})
+        return True
+
+    def dispatch(self, event):
+        kind = event['type']
+        if kind == 'direct':
+            for session in self._local.get(event['to'], {}).values():
+                session.deliver(event['text'])
+        elif kind == 'join':
+            self._online[event['username']] += 1
+        elif kind == 'part':
+            self._online[event['username']] -= 1
+            if self._online[event['username']] <= 0:
+                del self._online[event['username']]
+        elif kind == 'reset':
+            self._online.clear()
+
+
+_presence = Presence()
+def get_presence():
+    return _presence
@@ -0,0 +1,47 @@
+import time
+
+from bbs.cache import TTLCache
+
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class RateLimiter:
+    # One token bucket per key, refilling at `rate` tokens a second up to
+    # `burst`.  A bucket left alone for burst / rate seconds is full again, so
+    # that is how long it needs to be remembered; the LRU bound keeps a flood
+    # of distinct keys from growing memory without limit.
+    def __init__(self, rate, burst, maxsize=65536, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._buckets = TTLCache(maxsize=maxsize, ttl=burst / rate, clock=clock)
+
+    def allow(self, key, cost=1.0):
+        bucket = self._refill(key)
+        allowed = bucket.tokens >= cost
+        if allowed:
+            bucket.tokens -= cost
+        self._buckets.set(key, bucket)
+        return allowed
+
+    def peek(self, key, cost=1.0):
+        # Whether allow() would succeed, without spending anything.
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return self.burst >= cost
+        return min(self.burst, bucket.tokens + (self._clock() - bucket.updated) * self.rate) >= cost
+
+    def _refill(self, key):
+        now = self._clock()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return TokenBucket(self.burst, now)
+        bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+        bucket.updated = now
+        return bucket
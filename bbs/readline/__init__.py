@@ -2,38 +2,80 @@ import asyncio
 import collections
 import contextlib
 import re
+import time
 
 
-from bbs.readline.readlike import edit, keys
+from bbs.readline.cursor import CursorTracker
+from bbs.readline.readlike import LineEditor, keys
+
+# A cursor position report, and every prefix of one.
+_POSITION_REPORT = re.compile(r"\x1b\[(\d+);(\d+)R")
+_POSITION_PREFIX = re.compile(r"\x1b(\[(\d+(;\d*)?)?)?")
+
 
 class _ReadBuffer:
-    # The point of this code is to fight against a race condition in get_position that
-    # sees data that it shouldn't in the reader.  So....we buffer it, do our thing, and
-    # get on with our lives.  I think this works.  It appears to work.
+    # Everything read from the client goes through here, so get_position can
+    # pull the terminal's cursor report out of the stream and leave whatever
+    # the user typed around it to be read next.  Input is read from the
+    # telnet reader in bulk and handed out in order from a string and a read
+    # offset, so a pasted block costs one read however it is consumed.
+    CHUNK_SIZE = 4096
+
+    __slots__ = ('_reader', '_data', '_start', 'received', 'last_input')
+
     def __init__(self, reader):
         self._reader = reader
-        self._buffer = []
+        self._data = ''
+        self._start = 0
+        self.received = 0
+        self.last_input = time.monotonic()
+
+    def __len__(self):
+        return len(self._data) - self._start
+
+    async def _fill(self):
+        chunk = await self._reader.read(self.CHUNK_SIZE)
+        if chunk:
+            self.received += len(chunk)
+            self.last_input = time.monotonic()
+            self._data = self._data[self._start:] + chunk
+            self._start = 0
+        return bool(chunk)
 
-    def push(self, value):
-        self._buffer.extend(value)
+    def unread(self, value):
+        if value:
+            self._data = value + self._data[self._start:]
+            self._start = 0
+
+    def pop_nowait(self):
+        if self._start >= len(self._data):
+            return None
+        char = self._data[self._start]
+        self._start += 1
+        return char
 
     async def pop(self):
-        if not self._buffer:
-            return await self._reader.read(1)
-        return self._buffer.pop()
+        if self._start >= len(self._data) and not await self._fill():
+            return ''
+        return self.pop_nowait()
 
     def popall(self):
-        data = ''.join(self._buffer)
-        self._buffer.clear()
+        data = self._data[self._start:]
+        self._data = ''
+        self._start = 0
         return data
 
     async def readuntil(self, separator='\n'):
-        while True:
-            if separator in self._buffer:
-                break
-            self.push(await self._reader.read(1))
-        text = ''.join(self._buffer).split(separator, 1)[0] + separator
-        del self._buffer[: len(text)]
+        # Only the data that arrived since the last look is searched again;
+        # offsets are relative to the read position, which _fill rebases.
+        searched = 0
+        while (index := self._data.find(separator, self._start + searched)) < 0:
+            searched = max(0, len(self) - len(separator) + 1)
+            if not await self._fill():
+                raise asyncio.IncompleteReadError(self.popall(), None)
+        end = index + len(separator)
+        text = self._data[self._start:end]
+        self._start = end
         return text
 
     async def read(self, size=-1):
@@ -45,13 +87,47 @@ class _ReadBuffer:
                 block = await self._reader.read()
                 if not block:
                     break
+                self.received += len(block)
+                self.last_input = time.monotonic()
                 blocks.append(block)
             return ''.join(blocks)
-        return ''.join([await self.pop() for _ in range(size)])
+        if self._start >= len(self._data) and not await self._fill():
+            return ''
+        text = self._data[self._start:self._start + size]
+        self._start += len(text)
+        return text
+
+    async def readexactly(self, size):
+        blocks = []
+        while size > 0:
+            block = await self.read(size)
+            if not block:
+                partial = ''.join(blocks)
+                raise asyncio.IncompleteReadError(partial, len(partial) + size)
+            blocks.append(block)
+            size -= len(block)
+        return ''.join(blocks)
 
 
 class Readline:
     BREAK = object()
+    # How long to wait for a terminal to answer a cursor position query
+    # before falling back to the tracked guess.
+    POSITION_TIMEOUT = 2.0
+    # Output is collected and handed to the transport once per loop
+    # iteration, so a burst of small writes (a prompt, an echo, chat lines
+    # wrapped in cursor save/restore) goes out as one segment.  Past this
+    # many characters it is flushed straight away.  That only bounds the
+    # coalescing buffer: write() never waits, so code that can produce a lot
+    # of output awaits throttle() (or drain()) to let a slow client hold it
+    # back.
+    HIGH_WATER = 1 << 16
+
+    # One of these per connection, so no per-instance __dict__.
+    __slots__ = (
+        '_reader', '_writer', '_echo', '_readtask', '_readlock', '_readbuffer',
+        '_cursor', '_output', '_output_size', '_flush_handle', 'sent',
+    )
 
     def __init__(self, reader, writer):
         self._reader = reader
@@ -60,6 +136,27 @@ class Readline:
         self._readtask = None
         self._readlock = asyncio.Lock()
         self._readbuffer = _ReadBuffer(reader)
+        self._cursor = CursorTracker(writer.get_extra_info('cols'))
+        self._output = []
+        self._output_size = 0
+        self._flush_handle = None
+        self.sent = 0
+
+    @property
+    def received(self):
+        return self._readbuffer.received
+
+    @property
+    def last_input(self):
+        return self._readbuffer.last_input
+
+    def buffered(self):
+        # Characters held for this client: input not yet read, output not yet
+        # handed over, and whatever the transport has not sent.
+        held = len(self._readbuffer) + self._output_size
+        if not self._writer.is_closing():
+            held += self._writer.transport.get_write_buffer_size()
+        return held
 
     async def prompt(self, prompt):
         self.write(prompt)
@@ -77,35 +174,85 @@ class Readline:
         yield
         self._echo = old_echo
 
-    async def get_position(self):
+    async def get_position(self, timeout=None):
         if self._readlock.locked():
             self._readtask.cancel()
         async with self._readlock:
-            self._writer.write('\x1b[6n')
-            old_data = await self._readbuffer.readuntil('\x1b')
-            resp = '\x1b'
-            ch = ''
-            while not (match := re.match(r"^\x1b\[(\d+);(\d+)R", resp)):
-                ch = await self._reader.read(1)
-                resp += ch
-            if old_data[:-1]:
-                self._readbuffer.push(old_data[:-1])
-            return tuple(int(x) for x in match.groups())
+            self.write('\x1b[6n')
+            self.flush()
+            # Anything typed before (or between the pieces of) the report is
+            # put back for the next read, escape sequences included, even if
+            # the terminal never answers.
+            typed = []
+            try:
+                row, column = await asyncio.wait_for(self._read_position(typed), timeout)
+            finally:
+                self._readbuffer.unread(''.join(typed))
+            self._cursor.set(column)
+            return row, column
+
+    async def _read_position(self, typed):
+        while True:
+            typed.append((await self._readbuffer.readuntil('\x1b'))[:-1])
+            typed.append('\x1b')
+            while _POSITION_PREFIX.fullmatch(typed[-1]) and (char := await self._readbuffer.pop()):
+                typed[-1] += char
+                if match := _POSITION_REPORT.fullmatch(typed[-1]):
+                    typed.pop()
+                    return tuple(int(x) for x in match.groups())
+            # Not a report after all; the character that gave it away may
+            # start the real one, so it is looked at again.
+            resp = typed.pop()
+            typed.append(resp[:-1])
+            self._readbuffer.unread(resp[-1:])
+
+    async def get_column(self):
+        # The tracked column when it can be trusted, otherwise ask the
+        # terminal, and settle for the guess if it does not answer.
+        self._cursor.width = self.get_extra_info('cols')
+        if self._cursor.known:
+            return self._cursor.column
+        try:
+            _, column = await self.get_position(self.POSITION_TIMEOUT)
+        except asyncio.TimeoutError:
+            return self._cursor.column
+        return column
 
     def echo(self, data):
-        if self._echo:
-            return self._writer.echo(data)
+        if self._echo and self._writer.will_echo:
+            self.write(data)
 
     def write(self, data):
-        return self._writer.write(data)
+        self._cursor.feed(data)
+        self._output.append(data)
+        self._output_size += len(data)
+        if self._output_size >= self.HIGH_WATER:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_soon(self.flush)
 
     def writelines(self, data):
-        return self._writer.writelines(data)
+        for line in data:
+            self.write(line)
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._output:
+            return
+        data = ''.join(self._output)
+        self._output.clear()
+        self._output_size = 0
+        if not self._writer.is_closing():
+            self._writer.write(data)
+            self.sent += len(data)
 
     def can_write_eof(self):
         return self._writer.can_write_eof()
     
     def write_eof(self):
+        self.flush()
         return self._writer.write_eof()
 
     def transport(self):
@@ -115,9 +262,20 @@ class Readline:
         return self._writer.get_extra_info(name, default)
 
     async def drain(self):
+        self.flush()
         return await self._writer.drain()
+
+    async def throttle(self):
+        # drain(), but only once more than HIGH_WATER is waiting to go out,
+        # so small writes keep being coalesced.
+        pending = self._output_size
+        if not self._writer.is_closing():
+            pending += self._writer.transport.get_write_buffer_size()
+        if pending >= self.HIGH_WATER:
+            await self.drain()
     
     def close(self):
+        self.flush()
         return self._writer.close()
 
     def is_closing(self):
@@ -130,7 +288,7 @@ class Readline:
         return await self._readbuffer.read(n)
 
     async def readexactly(self, n):
-        return await self._reader.readexactly(n)
+        return await self._readbuffer.readexactly(n)
 
     async def readuntil(self, separator='\n'):
         return await self._readbuffer.readuntil(separator)
@@ -139,19 +297,22 @@ class Readline:
         _keys = keys()
         escape = ''
         char = ''
-        line = ''
-        col = 0
         if offset is None:
-            _, offset = await self.get_position()
-        else:
-            offset = offset
+            try:
+                offset = await self.get_column()
+            except asyncio.IncompleteReadError:
+                return self.BREAK
+        editor = LineEditor(offset)
         while True:
-            async with self._readlock:
-                self._readtask = asyncio.create_task(self.read(1))
-                try:
-                    char = await self._readtask
-                except asyncio.CancelledError:
-                    continue
+            # Only wait (in a task get_position can cancel) when nothing is
+            # buffered; typed-ahead and pasted input is consumed in place.
+            if (char := self._readbuffer.pop_nowait()) is None:
+                async with self._readlock:
+                    self._readtask = asyncio.create_task(self._readbuffer.pop())
+                    try:
+                        char = await self._readtask
+                    except asyncio.CancelledError:
+                        continue
             if char in '\x04\x03':
                 return self.BREAK
             if escape:
@@ -160,6 +321,10 @@ class Readline:
                     escape = '\x1b'
                     continue
                 escape += char
+                if _POSITION_REPORT.fullmatch(escape):
+                    # A late answer to a query that already timed out.
+                    escape = ''
+                    continue
                 if escape not in _keys:
                     continue
                 char, escape = escape, ''
@@ -167,9 +332,12 @@ class Readline:
                 escape += char
                 continue
             if char == '\r':
-                return line
-            line, col = edit(line, col, char)
-            self.echo(f'\x1b[{offset}G\x1b[0K{line}\x1b[{col+offset}G')
+                if not self._writer.will_echo:
+                    # The client echoed the line itself, return included.
+                    self._cursor.forget()
+                return editor.text
+            if output := editor.feed(char):
+                self.echo(output)
 
     def at_eof(self):
         return self._reader.at_eof()
@@ -0,0 +1,93 @@
+import re
+import unicodedata
+
+__all__ = ['CursorTracker']
+
+# One token of terminal output: a CSI sequence, another two-character escape,
+# a single control character, or a run of printable text.
+_TOKEN = re.compile(
+    r'\x1b\[([0-9;?]*)[ -/]*([@-~])'
+    r'|\x1b(.)'
+    r'|([\x00-\x1f\x7f])'
+    r'|([^\x00-\x1f\x7f\x1b]+)',
+    re.DOTALL,
+)
+
+# CSI finals that leave the cursor's column alone: vertical movement, erasing,
+# inserting and deleting characters or lines, attributes and reports.
+_CSI_KEEP = frozenset('ABJKLMPS@TXmnhlr')
+
+
+def _width(text):
+    if text.isascii():
+        return len(text)
+    width = 0
+    for char in text:
+        if unicodedata.combining(char):
+            continue
+        width += 2 if unicodedata.east_asian_width(char) in 'WF' else 1
+    return width
+
+
+class CursorTracker:
+    # Follows the cursor column through everything written to the terminal,
+    # so Readline can skip asking the terminal where the cursor is (a round
+    # trip per prompt).  The column is always a best guess; `known' says
+    # whether it can be trusted.  Anything the model does not understand, or
+    # text that may have wrapped, makes it unknown until a carriage return,
+    # an absolute move or a position report pins it down again.
+    __slots__ = ('column', 'known', 'width', '_saved')
+
+    def __init__(self, width=None):
+        self.column = 1
+        self.known = False
+        self.width = width
+        self._saved = (1, False)
+
+    def set(self, column):
+        self.column = column
+        self.known = True
+
+    def forget(self, column=1):
+        self.column = column
+        self.known = False
+
+    def feed(self, text):
+        column, known = self.column, self.known
+        for csi_params, csi_final, escape, control, printable in _TOKEN.findall(text):
+            if printable:
+                column += _width(printable)
+                if self.width and column > self.width:
+                    # Past the right margin the terminal has wrapped, or is
+                    # about to.
+                    column, known = (column - 1) % self.width + 1, False
+            elif control:
+                if control == '\r':
+                    column, known = 1, True
+                elif control == '\x08':
+                    column = max(1, column - 1)
+                elif control == '\t':
+                    column = (column - 1) // 8 * 8 + 9
+                elif control not in '\n\x07\x00':
+                    known = False
+            elif csi_final:
+                params = csi_params.split(';')
+                count = int(params[0]) if params[0].isdigit() else 1
+                if csi_final == 'G':
+                    column, known = count, True
+                elif csi_final in 'Hf':
+                    column = int(params[1]) if len(params) > 1 and params[1].isdigit() else 1
+                    known = True
+                elif csi_final == 'C':
+                    column += count
+                elif csi_final == 'D':
+                    column = max(1, column - count)
+                elif csi_final not in _CSI_KEEP:
+                    known = False
+            elif escape == '7':
+                self._saved = (column, known)
+            elif escape == '8':
+                column, known = self._saved
+            elif escape not in 'DM':
+                known = False
+        self.column, self.known = column, known
@@ -1,7 +1,7 @@
 # https://github.com/thomasballinger/curtsies/blob/master/curtsies/curtsieskeys.py
 # https://github.com/jangler/readlike/blob/master/readlike.py
 
-__all__ = ['edit', 'keys']
+__all__ = ['edit', 'keys', 'LineEditor']
 
 
 def _backward_char(text, pos):
@@ -332,9 +332,98 @@ def edit(text, pos, key):
         return text, pos
 
 
+_KEYS = frozenset(KEYS)
+_BACKSPACE = frozenset('\x7f\x08')
+
+
 def keys():
     """
     Return a frozenset of strings that describe key inputs corresponding
     to line editing commands.
     """
-    return frozenset(KEYS)
+    return _KEYS
+
+
+class LineEditor:
+    """
+    Editing state for a single line drawn on a terminal starting at
+    column `offset' (1-based).
+
+    feed() applies a key like edit() does, but keeps the line as a list
+    of characters and returns only the output needed to bring the screen
+    up to date: typing at the end of the line echoes just that character,
+    and other edits redraw only the part of the line that changed, using
+    insert-character (ICH), delete-character (DCH) and absolute column
+    (CHA) sequences.
+    """
+
+    __slots__ = ('chars', 'pos', 'offset')
+
+    def __init__(self, offset=1):
+        self.chars = []
+        self.pos = 0
+        self.offset = offset
+
+    @property
+    def text(self):
+        return ''.join(self.chars)
+
+    def feed(self, key):
+        chars, pos = self.chars, self.pos
+        if key in _BACKSPACE:
+            if pos == 0:
+                return ''
+            del chars[pos - 1]
+            self.pos = pos - 1
+            if pos > len(chars):
+                return '\x08\x1b[K'
+            return '\x08\x1b[P'
+        if key in _key_bindings:
+            old = ''.join(chars)
+            text, new_pos = _key_bindings[key](old, pos)
+            chars[:] = text
+            self.pos = new_pos
+            return self._diff(old, pos, text, new_pos)
+        if len(key) != 1:
+            return ''
+        self.pos = pos + 1
+        if pos == len(chars):
+            chars.append(key)
+            return key
+        chars.insert(pos, key)
+        return '\x1b[@' + key
+
+    def _diff(self, old, old_pos, new, new_pos):
+        """
+        Return the output that turns `old' on screen, with the cursor at
+        `old_pos', into `new' with the cursor at `new_pos'.
+        """
+        if old == new:
+            if old_pos == new_pos:
+                return ''
+            return f'\x1b[{self.offset + new_pos}G'
+        limit = min(len(old), len(new))
+        start = 0
+        while start < limit and old[start] == new[start]:
+            start += 1
+        tail = 0
+        while tail < limit - start and old[-1 - tail] == new[-1 - tail]:
+            tail += 1
+        removed = len(old) - tail - start
+        added = new[start:len(new) - tail]
+        out = []
+        if old_pos != start:
+            out.append(f'\x1b[{self.offset + start}G')
+        if not tail:
+            out.append(added)
+            if removed > len(added):
+                out.append('\x1b[K')
+        else:
+            if len(added) > removed:
+                out.append(f'\x1b[{len(added) - removed}@')
+            elif removed > len(added):
+                out.append(f'\x1b[{removed - len(added)}P')
+            out.append(added)
+        if new_pos != start + len(added):
+            out.append(f'\x1b[{self.offset + new_pos}G')
+        return ''.join(out)
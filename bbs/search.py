@@ -0,0 +1,129 @@
+import logging
+
+from tortoise import Tortoise
+from tortoise.transactions import in_transaction
+
+log = logging.getLogger(__name__)
+
+# Full-text index over document content, kept in an SQLite FTS5 table with one
+# row per DocumentChunk (the FTS rowid is the chunk id).  bbs.models keeps it
+# in step: a finished DocumentWriter indexes the new version's chunks and drops
+# the old ones, and Document.remove drops a whole subtree.  Other database
+# backends simply get no search.
+FTS_TABLE = 'document_fts'
+DOCUMENT_TABLE = 'document'
+CHUNK_TABLE = 'documentchunk'
+
+PAGE_SIZE = 10
+
+
+def _connection(connection=None):
+    return connection or Tortoise.get_connection('default')
+
+
+def available(connection=None):
+    return _connection(connection).capabilities.dialect == 'sqlite'
+
+
+def match_terms(text):
+    # Quote every term so user input can never be an FTS5 syntax error.
+    return list(dict.fromkeys('"' + term.replace('"', '""') + '"' for term in text.split()))
+
+
+async def search_init(connection=None):
+    connection = _connection(connection)
+    if not available(connection):
+        log.warning("full-text search needs SQLite FTS5, search is disabled")
+        return
+    await connection.execute_script(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} "
+        f"USING fts5(body, document_id UNINDEXED, tokenize='porter unicode61')"
+    )
+
+
+async def index_version(document_id, version, connection=None):
+    connection = _connection(connection)
+    if not available(connection):
+        return
+    await connection.execute_query(
+        f"DELETE FROM {FTS_TABLE} WHERE rowid IN "
+        f"(SELECT id FROM {CHUNK_TABLE} WHERE document_id = ? AND version != ?)",
+        [document_id, version],
+    )
+    await connection.execute_query(
+        f"INSERT INTO {FTS_TABLE} (rowid, body, document_id) "
+        f"SELECT id, data, document_id FROM {CHUNK_TABLE} "
+        f"WHERE document_id = ? AND version = ?",
+        [document_id, version],
+    )
+
+
+async def unindex_subtree(document_id, low, high, connection=None):
+    connection = _connection(connection)
+    if not available(connection):
+        return
+    await connection.execute_query(
+        f"DELETE FROM {FTS_TABLE} WHERE rowid IN "
+        f"(SELECT c.id FROM {CHUNK_TABLE} c JOIN {DOCUMENT_TABLE} d ON d.id = c.document_id "
+        f"WHERE d.id = ? OR (d.path > ? AND d.path < ?))",
+        [document_id, low, high],
+    )
+
+
+async def reindex(batch_size=200, after=0, connection=None):
+    # Rebuilds the index a batch of documents at a time, each batch in its own
+    # transaction, so it can run on a live system and be resumed from the
+    # last id it reported.
+    connection = _connection(connection)
+    if not available(connection):
+        return after
+    while True:
+        rows = await connection.execute_query_dict(
+            f"SELECT id FROM {DOCUMENT_TABLE} WHERE id > ? ORDER BY id LIMIT ?",
+            [after, batch_size],
+        )
+        if not rows:
+            return after
+        ids = [row['id'] for row in rows]
+        marks = ', '.join('?' * len(ids))
+        async with in_transaction(connection.connection_name) as transaction:
+            await transaction.execute_query(
+                f"DELETE FROM {FTS_TABLE} WHERE rowid IN "
+                f"(SELECT id FROM {CHUNK_TABLE} WHERE document_id IN ({marks}))",
+                ids,
+            )
+            await transaction.execute_query(
+                f"INSERT INTO {FTS_TABLE} (rowid, body, document_id) "
+                f"SELECT c.id, c.data, c.document_id FROM {CHUNK_TABLE} c "
+                f"JOIN {DOCUMENT_TABLE} d ON d.id = c.document_id AND d.version = c.version "
+                f"WHERE d.id IN ({marks})",
+                ids,
+            )
+        after = ids[-1]
+        log.info("reindexed documents up to id %d", after)
+
+
+async def search(text, page=1, page_size=PAGE_SIZE, connection=None):
+    # Documents with every term somewhere in them, not necessarily in the same
+    # chunk: each term is matched on its own and the documents intersected.
+    # Chunks with any of the terms are then ranked, and each document takes
+    # its best chunk's rank and snippet.  The inner LIMIT keeps SQLite from
+    # flattening the subquery into the GROUP BY, where the FTS5 ranking
+    # functions are not allowed.
+    connection = _connection(connection)
+    terms = match_terms(text)
+    if not terms or not available(connection):
+        return []
+    every = ' INTERSECT '.join(
+        f"SELECT document_id FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH ?" for _ in terms
+    )
+    return await connection.execute_query_dict(
+        f"SELECT d.path AS path, hit.snippet AS snippet, min(hit.rank) AS rank "
+        f"FROM (SELECT document_id, bm25({FTS_TABLE}) AS rank, "
+        f"snippet({FTS_TABLE}, 0, '', '', '...', 10) AS snippet "
+        f"FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH ? LIMIT -1) AS hit "
+        f"JOIN {DOCUMENT_TABLE} d ON d.id = hit.document_id "
+        f"WHERE hit.document_id IN ({every}) "
+        f"GROUP BY hit.document_id ORDER BY rank LIMIT ? OFFSET ?",
+        [' OR '.join(terms), *terms, page_size, (max(page, 1) - 1) * page_size],
+    )
@@ -1,4 +1,10 @@
+import asyncio
+import concurrent.futures
 import hashlib
+import logging
+import mmap
+import os
+import time
 
 import aiohttp
 from yarl import URL
@@ -6,20 +12,250 @@ from yarl import URL
 from passlib.context import CryptContext
 from password_strength import PasswordPolicy
 
+from bbs import metrics
+from bbs.cache import TTLCache
+
+log = logging.getLogger(__name__)
+
 PASSWORD_CONTEXT = CryptContext(schemes=['argon2'], deprecated='auto')
 
 PASSWORD_POLICY = PasswordPolicy.from_names(strength=0.66)
 
+def _hash(password):
+    return PASSWORD_CONTEXT.hash(password)
+
+def _verify(password, hashed):
+    return PASSWORD_CONTEXT.verify(password, hashed)
+
+_hash_seconds = metrics.Histogram(
+    'bbs_hash_seconds', "Password hashing time, queued for a worker and running", ['phase'],
+)
+_hash_queued = _hash_seconds.labels('queued')
+_hash_running = _hash_seconds.labels('running')
+
+class HashExecutor:
+    # argon2 is deliberately slow, so it runs off the event loop.  At most
+    # max_workers jobs are handed to the pool at once; the rest wait on the
+    # semaphore and show up as queue depth in stats().
+    KINDS = {
+        'process': concurrent.futures.ProcessPoolExecutor,
+        'thread': concurrent.futures.ThreadPoolExecutor,
+    }
+
+    def __init__(self, kind='process', max_workers=None):
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown executor kind {kind!r}")
+        self.kind = kind
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._executor = None
+        self._semaphore = None
+        self.waiting = 0
+        self.peak_waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.busy_time = 0.0
+
+    def _get_executor(self):
+        # Created on first use so that pre-forked workers each get their own.
+        if self._executor is None:
+            self._executor = self.KINDS[self.kind](max_workers=self.max_workers)
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+        return self._executor
+
+    async def run(self, func, *args):
+        executor = self._get_executor()
+        self.waiting += 1
+        self.peak_waiting = max(self.peak_waiting, self.waiting)
+        queued = time.perf_counter()
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        start = time.perf_counter()
+        _hash_queued.observe(start - queued)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+        finally:
+            elapsed = time.perf_counter() - start
+            _hash_running.observe(elapsed)
+            self.busy_time += elapsed
+            self.running -= 1
+            self.completed += 1
+            self._semaphore.release()
+
+    def stats(self):
+        return {
+            'kind': self.kind,
+            'max_workers': self.max_workers,
+            'waiting': self.waiting,
+            'peak_waiting': self.peak_waiting,
+            'running': self.running,
+            'completed': self.completed,
+            'busy_time': self.busy_time,
+        }
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+_hasher = HashExecutor()
+
+def configure_hasher(kind='process', max_workers=None):
+    global _hasher
+    _hasher.shutdown(wait=False)
+    _hasher = HashExecutor(kind, max_workers)
+    return _hasher
+
+def get_hasher():
+    return _hasher
+
+metrics.Gauge('bbs_hash_waiting', "Password hashes queued for a worker", fn=lambda: _hasher.waiting)
+
+async def ahash(password):
+    return await _hasher.run(_hash, password)
+
+async def averify(password, hashed):
+    return await _hasher.run(_verify, password, hashed)
+
+_dummy_hash = None
+
+async def averify_dummy(password):
+    # Spend the same argon2 time as a real check for usernames that do not
+    # exist, so response time does not tell an attacker which ones do.
+    global _dummy_hash
+    if _dummy_hash is None:
+        _dummy_hash = await ahash(os.urandom(16).hex())
+    await averify(password, _dummy_hash)
+    return False
+
 async def is_valid(password):
     breached = not (await is_breached(password))
     strong = PASSWORD_POLICY.test(password) == []
     return all([breached, strong])
 
-async def is_breached(password):
-    value = hashlib.sha1(password.encode("utf8")).hexdigest().upper()
-    url = URL("https://api.pwnedpasswords.com/range") / value[:5]
-    async with aiohttp.ClientSession() as client:
-        async with client.get(url, headers={'User-Agent': "bbs.security (Python)"}) as resp:
+BREACH_RANGE_URL = URL("https://api.pwnedpasswords.com/range")
+
+class OfflineCorpus:
+    # A local copy of the Pwned Passwords list ordered by hash: one
+    # "SHA1:COUNT" line per entry.  The file is memory-mapped and
+    # binary-searched, so a lookup touches a handful of pages however large
+    # the corpus is.
+    PROBES = 64
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fp:
+            # An empty file cannot be mapped, and holds no hashes anyway.
+            if os.fstat(fp.fileno()).st_size:
+                self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._map = b''
+        try:
+            self._check_order()
+        except ValueError:
+            self.close()
+            raise
+
+    def _check_order(self):
+        # Checking every line would read the whole file.  The list ordered by
+        # prevalence, the easy one to download by mistake, already fails on a
+        # few lines spread evenly through it.
+        data = self._map
+        last = b''
+        for i in range(self.PROBES + 1):
+            start = data.rfind(b'\n', 0, (len(data) - 1) * i // self.PROBES) + 1
+            end = data.find(b'\n', start)
+            key = data[start:end if end >= 0 else len(data)].partition(b':')[0].strip()
+            if not key:
+                continue
+            if key < last:
+                raise ValueError(f"{self.path} is not sorted by hash; use the list ordered by hash")
+            last = key
+
+    def __contains__(self, digest):
+        data = self._map
+        lo, hi = 0, len(data)
+        while lo < hi:
+            start = data.rfind(b'\n', 0, (lo + hi) // 2) + 1
+            end = data.find(b'\n', start)
+            if end < 0:
+                end = len(data)
+            key = data[start:start + len(digest)]
+            if key == digest:
+                return True
+            if key < digest:
+                lo = end + 1
+            else:
+                hi = start
+        return False
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+
+class BreachChecker:
+    # Checks hashes against the offline corpus when one is configured, and
+    # otherwise against the k-anonymity range API through one pooled session
+    # with range responses cached by prefix.  A remote failure counts as "not
+    # breached" so that registrations and password changes never hinge on
+    # the API being up.
+    def __init__(self, corpus=None, remote=True, timeout=5.0, ttl=3600, maxsize=4096):
+        self.corpus = OfflineCorpus(corpus) if corpus else None
+        self.remote = remote
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self._ranges = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._client = None
+
+    def _get_client(self):
+        if self._client is None or self._client.closed:
+            self._client = aiohttp.ClientSession(
+                timeout=self.timeout,
+                headers={'User-Agent': "bbs.security (Python)"},
+            )
+        return self._client
+
+    async def _fetch_range(self, prefix):
+        async with self._get_client().get(BREACH_RANGE_URL / prefix) as resp:
+            resp.raise_for_status()
             response = await resp.text()
-    entries = {h: int(c) for h, c in (v.split(':') for v in response.upper().split("\r\n"))}
-    return value[5:] in entries
+        return frozenset(line.partition(':')[0] for line in response.upper().splitlines())
+
+    async def check(self, password):
+        value = hashlib.sha1(password.encode("utf8")).hexdigest().upper()
+        if self.corpus is not None:
+            return value.encode('ascii') in self.corpus
+        if not self.remote:
+            return False
+        prefix, suffix = value[:5], value[5:]
+        suffixes = self._ranges.get(prefix)
+        if suffixes is None:
+            try:
+                suffixes = await self._fetch_range(prefix)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                log.warning("breach check unavailable: %r", exc)
+                return False
+            self._ranges.set(prefix, suffixes)
+        return suffix in suffixes
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+        if self.corpus is not None:
+            self.corpus.close()
+
+_breach_checker = BreachChecker()
+
+def configure_breach_check(corpus=None, remote=True, timeout=5.0, ttl=3600):
+    global _breach_checker
+    _breach_checker = BreachChecker(corpus, remote, timeout, ttl)
+    return _breach_checker
+
+async def is_breached(password):
+    return await _breach_checker.check(password)
+
+async def security_cleanup():
+    await _breach_checker.close()
+    _hasher.shutdown()
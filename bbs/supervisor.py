@@ -0,0 +1,329 @@
+import asyncio
+import collections
+import json
+import logging
+import os
+import select
+import signal
+import socket
+import time
+
+from bbs.bus import BrokerBus, run_broker
+from bbs.chat import get_chat
+from bbs.connections import get_connections
+from bbs.metrics import start_metrics, stop_metrics
+from bbs.models import models_init, models_cleanup
+from bbs.security import security_cleanup
+from bbs.telnet import start_telnet, active_sessions
+from bbs.watchdog import start_watchdog, stop_watchdog
+
+log = logging.getLogger(__name__)
+
+
+def _report(fd, started, serving, lag=0.0):
+    report = {
+        'pid': os.getpid(),
+        'uptime': round(time.monotonic() - started, 1),
+        'serving': serving.is_set(),
+        'sessions': active_sessions(),
+        'loop_lag': round(lag, 4),
+    }
+    os.write(fd, json.dumps(report).encode('utf8') + b'\n')
+
+
+async def _heartbeat(fd, interval, started, serving):
+    lag = 0.0
+    while True:
+        _report(fd, started, serving, lag)
+        before = time.monotonic()
+        await asyncio.sleep(interval)
+        lag = time.monotonic() - before - interval
+
+
+async def serve_worker(sock, bus_path, health_fd, heartbeat=5.0, grace=30.0,
+                       metrics_sock=None, stall_threshold=0.25, stall_log=None):
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stopping.set)
+    loop.add_signal_handler(signal.SIGINT, stopping.set)
+    # Heartbeats start at once, so a slow start is not taken for a hang, and
+    # say whether the worker is accepting connections yet.
+    started = time.monotonic()
+    serving = asyncio.Event()
+    beat = asyncio.create_task(_heartbeat(health_fd, heartbeat, started, serving))
+    try:
+        await models_init()
+        await start_metrics(sock=metrics_sock)
+        # A retiring worker of the same slot may still be writing its own.
+        start_watchdog(stall_threshold, stall_log and f'{stall_log}.{os.getpid()}')
+        await get_chat().use_bus(BrokerBus(bus_path))
+        tserver = await start_telnet(sock=sock)
+        serving.set()
+        _report(health_fd, started, serving)
+        await stopping.wait()
+        # Stop accepting, then give the sessions we already have a chance to
+        # finish before the process goes away.
+        tserver.close()
+        # The replacement serves this slot's metrics from here on.
+        await stop_metrics()
+        deadline = loop.time() + grace
+        while active_sessions() and loop.time() < deadline:
+            await asyncio.sleep(0.5)
+    finally:
+        beat.cancel()
+        await get_connections().close()
+        stop_watchdog()
+        await stop_metrics()
+        await get_chat().close()
+        await models_cleanup()
+        await security_cleanup()
+
+
+class Worker:
+    def __init__(self, slot, pid, health):
+        self.slot = slot
+        self.pid = pid
+        self.health = health
+        self.started = time.monotonic()
+        self.last_seen = self.started
+        self.report = {}
+        self._partial = b''
+
+    @property
+    def serving(self):
+        return self.report.get('serving', False)
+
+    def feed(self, data):
+        *lines, self._partial = (self._partial + data).split(b'\n')
+        for line in lines:
+            self.report = json.loads(line)
+            self.last_seen = time.monotonic()
+
+
+class Supervisor:
+    def __init__(self, workers, host='', port=6023, bus_path='bbs-chat.sock',
+                 heartbeat=5.0, timeout=30.0, grace=30.0, metrics_port=None, metrics_host='127.0.0.1',
+                 stall_threshold=0.25, stall_log=None):
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.bus_path = bus_path
+        self.heartbeat = heartbeat
+        self.timeout = timeout
+        self.grace = grace
+        # Worker n serves its metrics on metrics_port + n, from a socket bound
+        # here once so that a restarted worker can take over the slot while
+        # the one it replaces is still draining.
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        self._metrics_socks = {}
+        # Each worker process rotates its own stall log, stall_log.<pid>.
+        self.stall_threshold = stall_threshold
+        self.stall_log = stall_log
+        self._sock = None
+        self._broker = None
+        self._children = {}
+        self._retired = set()
+        # slot -> when a worker that died young may be started again.
+        self._respawn_at = {}
+        # A rolling restart replaces the workers queued in _rolling one at a
+        # time: _replacing is the one whose replacement is starting up.
+        self._rolling = collections.deque()
+        self._replacing = None
+        self._restart = False
+        self._stop = False
+
+    def _fork(self, target):
+        pid = os.fork()
+        if pid:
+            return pid
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGUSR1):
+            signal.signal(sig, signal.SIG_DFL)
+        code = 0
+        try:
+            target()
+        except BaseException:
+            log.exception("child %s crashed", os.getpid())
+            code = 1
+        finally:
+            os._exit(code)
+
+    def _spawn_broker(self):
+        self._broker = self._fork(lambda: asyncio.run(run_broker(self.bus_path)))
+        deadline = time.monotonic() + 5
+        while not os.path.exists(self.bus_path) and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def _spawn_worker(self, slot):
+        self._respawn_at.pop(slot, None)
+        read_fd, write_fd = os.pipe()
+
+        def target():
+            os.close(read_fd)
+            for worker in self._children.values():
+                os.close(worker.health)
+            asyncio.run(serve_worker(
+                self._sock, self.bus_path, write_fd,
+                heartbeat=self.heartbeat, grace=self.grace,
+                metrics_sock=self._metrics_socks.get(slot),
+                stall_threshold=self.stall_threshold,
+                stall_log=self.stall_log,
+            ))
+
+        pid = self._fork(target)
+        os.close(write_fd)
+        os.set_blocking(read_fd, False)
+        self._children[pid] = Worker(slot, pid, read_fd)
+        log.info("worker %d started as pid %d", slot, pid)
+
+    def _retire(self, worker, sig=signal.SIGTERM):
+        if self._children.pop(worker.pid, None) is not None:
+            os.close(worker.health)
+        self._retired.add(worker.pid)
+        _kill(worker.pid, sig)
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            if pid == self._broker:
+                log.warning("chat broker exited %s", _exit_status(status))
+                if not self._stop:
+                    self._spawn_broker()
+                continue
+            self._retired.discard(pid)
+            worker = self._children.pop(pid, None)
+            if worker is None:
+                continue
+            os.close(worker.health)
+            log.warning("worker %d (pid %d) exited %s", worker.slot, pid, _exit_status(status))
+            # Something that dies immediately after starting would otherwise
+            # be respawned in a tight loop.
+            self._respawn(worker.slot, 1.0 if time.monotonic() - worker.started < 1 else 0.0)
+
+    def _respawn(self, slot, delay=0.0):
+        # Unless the slot already has a worker other than one being replaced:
+        # when either half of a rolling restart dies the other carries on.
+        if self._stop or any(w.slot == slot and w is not self._replacing for w in self._children.values()):
+            return
+        if delay:
+            self._respawn_at[slot] = time.monotonic() + delay
+        else:
+            self._spawn_worker(slot)
+
+    def _respawn_due(self):
+        now = time.monotonic()
+        for slot, due in list(self._respawn_at.items()):
+            if due <= now:
+                del self._respawn_at[slot]
+                self._respawn(slot)
+
+    def _rolling_restart(self):
+        self._rolling.extend(pid for pid in self._children if pid not in self._rolling)
+
+    def _advance_restart(self):
+        # The next worker is only replaced once the replacement for the last
+        # one reports that it is serving, so the slots never all go down.
+        if (old := self._replacing) is not None:
+            if not any(w.slot == old.slot and w is not old and w.serving for w in self._children.values()):
+                return
+            self._replacing = None
+            if old.pid in self._children:
+                self._retire(old)
+            log.info("worker %d (pid %d) replaced", old.slot, old.pid)
+        while self._rolling:
+            if (old := self._children.get(self._rolling.popleft())) is not None:
+                self._replacing = old
+                self._spawn_worker(old.slot)
+                return
+
+    def _check_health(self):
+        now = time.monotonic()
+        for worker in list(self._children.values()):
+            if now - worker.last_seen > self.timeout:
+                log.warning("worker %d (pid %d) missed heartbeats, killing", worker.slot, worker.pid)
+                self._retire(worker, signal.SIGKILL)
+                self._respawn(worker.slot)
+
+    def status(self):
+        return {worker.slot: dict(worker.report, pid=worker.pid) for worker in self._children.values()}
+
+    def _log_status(self):
+        for slot, report in sorted(self.status().items()):
+            log.info("worker %d: %s", slot, report)
+
+    def run(self):
+        self._sock = socket.create_server((self.host, self.port), backlog=1024)
+        if self.metrics_port is not None:
+            for slot in range(self.workers):
+                self._metrics_socks[slot] = socket.create_server((self.metrics_host, self.metrics_port + slot))
+        self._spawn_broker()
+        for slot in range(self.workers):
+            self._spawn_worker(slot)
+
+        def request_stop(signum, frame):
+            self._stop = True
+
+        def request_restart(signum, frame):
+            self._restart = True
+
+        signal.signal(signal.SIGTERM, request_stop)
+        signal.signal(signal.SIGINT, request_stop)
+        signal.signal(signal.SIGHUP, request_restart)
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self._log_status())
+        try:
+            while not self._stop:
+                fds = {worker.health: worker for worker in self._children.values()}
+                wait = min([1.0, *(due - time.monotonic() for due in self._respawn_at.values())])
+                ready, _, _ = select.select(list(fds), [], [], max(0.0, wait))
+                for fd in ready:
+                    try:
+                        data = os.read(fd, 65536)
+                    except BlockingIOError:
+                        continue
+                    if data:
+                        fds[fd].feed(data)
+                self._reap()
+                self._respawn_due()
+                if self._restart:
+                    self._restart = False
+                    log.info("rolling restart requested")
+                    self._rolling_restart()
+                self._advance_restart()
+                self._check_health()
+        finally:
+            self._shutdown()
+
+    def _shutdown(self):
+        self._stop = True
+        for worker in list(self._children.values()):
+            self._retire(worker)
+        deadline = time.monotonic() + self.grace
+        while self._retired and time.monotonic() < deadline:
+            time.sleep(0.1)
+            self._reap()
+        for pid in self._retired:
+            _kill(pid, signal.SIGKILL)
+        if self._broker is not None:
+            _kill(self._broker, signal.SIGTERM)
+        self._sock.close()
+        for sock in self._metrics_socks.values():
+            sock.close()
+
+
+def _exit_status(status):
+    code = os.waitstatus_to_exitcode(status)
+    if code < 0:
+        return f"on signal {-code} ({signal.strsignal(-code)})"
+    return f"with status {code}"
+
+
+def _kill(pid, sig):
+    try:
+        os.kill(pid, sig)
+    except ProcessLookupError:
+        pass
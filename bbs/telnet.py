@@ -1,24 +1,92 @@
 import asyncio
+import time
 
 import telnetlib3
 
 import bbs.models
+from bbs import metrics
 from bbs.command_processor import MainProcessor
+from bbs.connections import get_connections
+from bbs.presence import get_presence
+from bbs.ratelimit import RateLimiter
 from bbs.readline import Readline
+from bbs.security import averify_dummy
+
+# Login attempts allowed per client address and per username: a short burst,
+# then one every few seconds.  The buckets live in each process, so with
+# --workers N an attacker spread over the workers gets up to N times these.
+_ip_limiter = RateLimiter(rate=1 / 6, burst=10)
+_username_limiter = RateLimiter(rate=1 / 30, burst=5)
+_login_limits = True
+_login_seconds = metrics.Histogram(
+    'bbs_login_seconds', "Time from submitting a password to the answer", ['result'],
+)
+
+def configure_login_limits(enabled=True, per_ip=None, per_username=None):
+    # per_ip and per_username are (rate, burst) pairs.  Load tests against a
+    # local server turn the limits off entirely.
+    global _ip_limiter, _username_limiter, _login_limits
+    _login_limits = enabled
+    if per_ip is not None:
+        _ip_limiter = RateLimiter(*per_ip)
+    if per_username is not None:
+        _username_limiter = RateLimiter(*per_username)
 
 async def login(reader):
     username = await reader.prompt('username: ')
-    user = await bbs.models.User.get_user(username)
+    if username is reader.BREAK:
+        return username
     with reader.no_echo():
         password = await reader.prompt('\r\npassword: ')
+    if password is reader.BREAK:
+        return password
+    started = time.perf_counter()
+    user, result = await _check_login(reader, username, password)
+    _login_seconds.labels(result).observe(time.perf_counter() - started)
+    return user
+
+async def _check_login(reader, username, password):
+    if _login_limits:
+        host, *_ = reader.get_extra_info('peername') or ('',)
+        # Every attempt is charged to its address.  An account is only
+        # charged for failed ones, so guessing at it from many addresses
+        # gets throttled without locking its owner out.
+        if not (_ip_limiter.allow(host) and _username_limiter.peek(username)):
+            reader.write('\r\nToo many login attempts, try again later.')
+            return None, 'limited'
+    user = await bbs.models.User.get_user(username)
     if user is None:
-        return None
-    if user.verify(password):
-        return user
-    return None
+        await averify_dummy(password)
+        result = 'unknown'
+    elif await user.averify(password):
+        return user, 'ok'
+    else:
+        result = 'bad'
+    if _login_limits:
+        _username_limiter.allow(username)
+    return None, result
+
+def active_sessions():
+    return len(get_connections())
+
+metrics.Gauge('bbs_sessions', "Open telnet sessions", fn=active_sessions)
+_sessions_total = metrics.Counter('bbs_sessions_total', "Telnet sessions accepted")
 
 async def shell(reader, writer):
+    _sessions_total.inc()
     reader, writer = Readline.wrap_streams(reader, writer)
+    connection = get_connections().add(writer)
+    if connection is None:
+        writer.write('Too many connections, try again later.\r\n')
+        await writer.drain()
+        writer.close()
+        return
+    try:
+        await _shell(reader, writer, connection)
+    finally:
+        get_connections().remove(connection)
+
+async def _shell(reader, writer, connection):
     user = None
     while not user:
         user = await login(reader)
@@ -27,15 +95,33 @@ async def shell(reader, writer):
             writer.close()
             return
         writer.write('\r\n')
-    writer.write(f'Greetings {user}!\r\n')
-    writer.write(f'Your home directory is {await (await user.home).full_path()}\r\n')
-    writer.write((await MainProcessor(user, reader, writer).process()) + '\r\n')
-    await writer.drain()
+    get_connections().login(connection, user.username)
+    session = await get_presence().enter(user.username, writer)
+    try:
+        writer.write(f'Greetings {user}!\r\n')
+        if (home := await bbs.models.Document.resolve_id(user.home_id)) is not None:
+            writer.write(f'Your home directory is {home.path}\r\n')
+        else:
+            writer.write('Your home directory is missing, starting in /\r\n')
+        writer.write((await MainProcessor(user, reader, writer).process()) + '\r\n')
+        await writer.drain()
+    finally:
+        await get_presence().leave(session)
     writer.close()
 
-async def start_telnet(host='', port=6023):
+async def start_telnet(host='', port=6023, sock=None):
+    # telnetlib3's own idle timeout keeps a timer per connection and re-arms
+    # it on every packet; the connection manager's wheel does that job.
+    if sock is not None:
+        # A listening socket inherited from the pre-fork supervisor.
+        loop = asyncio.get_running_loop()
+        return await loop.create_server(
+            lambda: telnetlib3.TelnetServer(shell=shell, timeout=0),
+            sock=sock,
+        )
     return await telnetlib3.create_server(
         host=host,
         port=port,
         shell=shell,
+        timeout=0,
     )
\ No newline at end of file
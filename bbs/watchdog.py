@@ -0,0 +1,201 @@
+import asyncio
+import collections
+import logging
+import logging.handlers
+import os
+import sys
+import threading
+import time
+import traceback
+
+from bbs import metrics
+
+log = logging.getLogger(__name__)
+
+_stalls = metrics.Counter('bbs_loop_stalls_total', "Event loop stalls longer than the watchdog threshold")
+_stall_seconds = metrics.Histogram(
+    'bbs_loop_stall_seconds', "Length of event loop stalls",
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+
+_PACKAGE = os.path.dirname(os.path.abspath(__file__)) + os.sep
+_HANDLE_RUN = os.path.join('asyncio', 'events.py')
+
+
+# Where the loop was stuck, summed over every stall blamed on it.
+class Offender:
+    __slots__ = ('where', 'count', 'total', 'worst', 'stack', 'last')
+
+    def __init__(self, where):
+        self.where = where
+        self.count = 0
+        self.total = 0.0
+        self.worst = 0.0
+        self.stack = None
+        self.last = 0.0
+
+    def add(self, seconds, stack):
+        self.count += 1
+        self.total += seconds
+        self.last = time.time()
+        if seconds >= self.worst:
+            self.worst = seconds
+            self.stack = stack
+
+
+def _trim(stack):
+    # Drop the event loop's own frames above the callback that was running.
+    for i in range(len(stack) - 1, -1, -1):
+        if stack[i].name == '_run' and stack[i].filename.endswith(_HANDLE_RUN):
+            return stack[i + 1:] or stack
+    return stack
+
+
+def _culprit(stack):
+    # The innermost frame in our own code, which is usually the line to fix
+    # even when the time is spent in a library below it.
+    for frame in reversed(stack):
+        if frame.filename.startswith(_PACKAGE):
+            break
+    else:
+        frame = stack[-1]
+    return f"{frame.name} ({os.path.relpath(frame.filename, os.path.dirname(_PACKAGE))}:{frame.lineno})"
+
+
+# The loop re-arms a timer every interval seconds.  A thread watches how late
+# that timer is; once it is more than threshold late the loop is stuck in a
+# callback, and the thread samples the loop thread's stack until it comes
+# back.  The loop then files the stall under its most common sample.  While
+# the loop is healthy the thread costs one wakeup per sample period.
+class StallWatchdog:
+    SAMPLES = 50
+    DEPTH = 40
+
+    def __init__(self, threshold=0.25, interval=None, sample_interval=None, keep=100):
+        self.threshold = threshold
+        self.interval = interval or threshold / 2
+        self.sample_interval = sample_interval or max(0.005, threshold / 5)
+        self.keep = keep
+        self.offenders = {}
+        self.stalls = 0
+        self._samples = []
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._thread_id = None
+        self._handle = None
+        self._due = 0.0
+        self._stop = threading.Event()
+
+    def start(self, loop=None):
+        self._loop = loop or asyncio.get_running_loop()
+        self._thread_id = threading.get_ident()
+        self._stop.clear()
+        self._arm()
+        self._thread = threading.Thread(target=self._watch, name='bbs-stall-watchdog', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _arm(self):
+        self._due = time.monotonic() + self.interval
+        self._handle = self._loop.call_later(self.interval, self._tick)
+
+    def _tick(self):
+        late = time.monotonic() - self._due
+        with self._lock:
+            samples, self._samples = self._samples, []
+        if late > self.threshold:
+            self._record(late, samples)
+        self._arm()
+
+    def _watch(self):
+        while not self._stop.wait(self.sample_interval):
+            if time.monotonic() - self._due <= self.threshold:
+                continue
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            # No source lookups here: the loop thread is the one in trouble,
+            # and this one should get out of its way.
+            stack = traceback.StackSummary.extract(
+                traceback.walk_stack(frame), limit=self.DEPTH, lookup_lines=False,
+            )
+            stack.reverse()
+            del frame
+            with self._lock:
+                if len(self._samples) < self.SAMPLES:
+                    self._samples.append(stack)
+
+    def _record(self, seconds, samples):
+        self.stalls += 1
+        _stalls.inc()
+        _stall_seconds.observe(seconds)
+        if samples:
+            stacks = {}
+            counts = collections.Counter()
+            for stack in samples:
+                key = tuple((f.filename, f.lineno, f.name) for f in stack)
+                stacks.setdefault(key, stack)
+                counts[key] += 1
+            key, hits = counts.most_common(1)[0]
+            stack = _trim(stacks[key])
+            where = _culprit(stack)
+            text = ''.join(traceback.format_list(stack))
+        else:
+            # Over before the sampler got a look at it.
+            where, hits, text = 'unsampled', 0, ''
+        offender = self.offenders.get(where)
+        if offender is None:
+            if len(self.offenders) >= self.keep:
+                del self.offenders[min(self.offenders.values(), key=lambda o: o.total).where]
+            offender = self.offenders[where] = Offender(where)
+        offender.add(seconds, text)
+        log.warning(
+            "event loop stalled for %.3fs in %s (%d/%d samples)\n%s",
+            seconds, where, hits, len(samples), text.rstrip('\n'),
+        )
+
+    def top(self, count=10):
+        return sorted(self.offenders.values(), key=lambda o: o.total, reverse=True)[:count]
+
+
+_watchdog = None
+
+
+def get_watchdog():
+    return _watchdog
+
+
+def start_watchdog(threshold=0.25, log_path=None, max_bytes=1 << 20, backups=5):
+    # threshold of 0 or None turns the watchdog off.  Stall reports go to
+    # log_path, rotated, when given, and to the normal log otherwise.
+    global _watchdog
+    if not threshold or _watchdog is not None:
+        return _watchdog
+    if log_path:
+        handler = logging.handlers.RotatingFileHandler(log_path, maxBytes=max_bytes, backupCount=backups)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(process)d %(message)s'))
+        log.addHandler(handler)
+        log.propagate = False
+    _watchdog = StallWatchdog(threshold)
+    _watchdog.start()
+    return _watchdog
+
+
+def stop_watchdog():
+    global _watchdog
+    if _watchdog is not None:
+        _watchdog.stop()
+        _watchdog = None
+    for handler in list(log.handlers):
+        log.removeHandler(handler)
+        handler.close()
+    log.propagate = True
@@ -0,0 +1,105 @@
+import asyncio
+
+from bbs.bus import MAX_LINE, Broker, BrokerBus, _encode
+
+
+async def _until(predicate, timeout=2.0):
+    async with asyncio.timeout(timeout):
+        while not predicate():
+            await asyncio.sleep(0.01)
+
+
+def _joins(events):
+    return [(e['channel'], e['username']) for e in events if e['type'] == 'join']
+
+
+def test_reconnect_replays_joins(tmp_path):
+    path = str(tmp_path / 'bus.sock')
+
+    async def main():
+        broker = Broker(path)
+        await broker.start()
+        seen = []
+        bus = BrokerBus(path, retry=0.05)
+        await bus.connect(seen.append)
+        await bus.publish({'type': 'join', 'channel': 'lobby', 'username': 'alice'})
+        await bus.publish({'type': 'join', 'channel': 'lobby', 'username': 'bob'})
+        await bus.publish({'type': 'part', 'channel': 'lobby', 'username': 'bob'})
+        await _until(lambda: len(seen) == 4)
+
+        # The broker restarts with an empty presence table; the bus notices,
+        # resets its subscriber and announces its remaining joins again.
+        await broker.close()
+        seen.clear()
+        broker = Broker(path)
+        await broker.start()
+        await _until(lambda: _joins(seen))
+        assert seen[0] == {'type': 'reset'}
+        assert _joins(seen) == [('lobby', 'alice')]
+
+        # So a worker connecting now learns alice is in the lobby, and not bob.
+        late = []
+        other = BrokerBus(path)
+        await other.connect(late.append)
+        await _until(lambda: _joins(late))
+        assert _joins(late) == [('lobby', 'alice')]
+
+        await other.close()
+        await bus.close()
+        await broker.close()
+
+    asyncio.run(main())
+
+
+def test_broker_drops_overlong_line(tmp_path):
+    path = str(tmp_path / 'bus.sock')
+
+    async def main():
+        broker = Broker(path)
+        await broker.start()
+        seen = []
+        bus = BrokerBus(path)
+        await bus.connect(seen.append)
+
+        reader, writer = await asyncio.open_unix_connection(path)
+        writer.write(_encode({'type': 'join', 'channel': 'lobby', 'username': 'mallory'}))
+        writer.write(b'x' * (MAX_LINE + 1) + b'\n')
+        await writer.drain()
+        # The client is cut off and parted like one that went away...
+        async with asyncio.timeout(2.0):
+            while await reader.read(1 << 16):
+                pass
+        await _until(lambda: any(e['type'] == 'part' for e in seen))
+        assert seen[-1] == {'type': 'part', 'channel': 'lobby', 'username': 'mallory'}
+        writer.close()
+
+        # ...and everybody else keeps going.
+        await bus.publish({'type': 'broadcast', 'text': 'still here'})
+        await _until(lambda: seen[-1]['type'] == 'broadcast')
+
+        await bus.close()
+        await broker.close()
+
+    asyncio.run(main())
+
+
+def test_publish_drops_overlong_event(tmp_path):
+    path = str(tmp_path / 'bus.sock')
+
+    async def main():
+        broker = Broker(path)
+        await broker.start()
+        seen = []
+        bus = BrokerBus(path)
+        await bus.connect(seen.append)
+
+        await bus.publish({'type': 'broadcast', 'text': 'x' * MAX_LINE})
+        await bus.publish({'type': 'broadcast', 'text': 'small'})
+        await _until(lambda: any(e['type'] == 'broadcast' for e in seen))
+        await asyncio.sleep(0.05)
+        assert [e['text'] for e in seen if e['type'] == 'broadcast'] == ['small']
+
+        await bus.close()
+        await broker.close()
+
+    asyncio.run(main())
@@ -0,0 +1,150 @@
+import asyncio
+import random
+import re
+
+import pytest
+
+from bbs.readline import Readline
+from bbs.readline.readlike import LineEditor, edit
+
+_CSI = re.compile(r'\x1b\[(\d*)([@GKP])')
+
+
+class _Terminal:
+    # Just enough of a terminal for the line editor's output: one line of
+    # cells, backspace, and the ICH, DCH, EL and CHA sequences.
+    def __init__(self, prompt):
+        self.cells = list(prompt)
+        self.column = len(prompt)
+
+    def feed(self, output):
+        i = 0
+        while i < len(output):
+            if match := _CSI.match(output, i):
+                count = int(match[1] or 1)
+                final = match[2]
+                if final == '@':
+                    self.cells[self.column:self.column] = ' ' * count
+                elif final == 'P':
+                    del self.cells[self.column:self.column + count]
+                elif final == 'K':
+                    del self.cells[self.column:]
+                else:
+                    self.column = count - 1
+                    self.cells.extend(' ' * (self.column - len(self.cells)))
+                i = match.end()
+                continue
+            char = output[i]
+            assert char != '\x1b', f'unexpected escape in {output!r}'
+            if char == '\x08':
+                self.column = max(0, self.column - 1)
+            else:
+                self.cells[self.column:self.column + 1] = char
+                self.column += 1
+            i += 1
+
+    @property
+    def line(self):
+        return ''.join(self.cells).rstrip(' ')
+
+
+_KEYS = [
+    *'abc d', ' ', '\x7f', '\x08', '\x01', '\x05', '\x02', '\x06', '\x0b', '\x14', '\x15', '\x17',
+    '\x1b[3~', '\x1b[D', '\x1b[C', '\x1bb', '\x1bf', '\x1bd', '\x1b\x7f', '\x1bc', '\x1bu', '\x1bl',
+    '\x1bt', '\x1b\\', '\x1b[A',
+]
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_line_editor_output_matches_edit(seed):
+    rng = random.Random(seed)
+    prompt = '>>> '
+    editor = LineEditor(len(prompt) + 1)
+    terminal = _Terminal(prompt)
+    text, pos = '', 0
+    for _ in range(300):
+        key = rng.choice(_KEYS)
+        terminal.feed(editor.feed(key))
+        text, pos = edit(text, pos, key)
+        assert editor.text == text, repr(key)
+        assert editor.pos == pos, repr(key)
+        # Trailing spaces are invisible either way.
+        assert terminal.line == (prompt + text).rstrip(' '), repr(key)
+        assert terminal.column == len(prompt) + pos, repr(key)
+
+
+def test_typing_at_end_echoes_only_the_key():
+    editor = LineEditor(5)
+    assert [editor.feed(c) for c in 'hi'] == ['h', 'i']
+    assert editor.feed('\x7f') == '\x08\x1b[K'
+
+
+class _Reader:
+    def __init__(self, *chunks):
+        self.chunks = asyncio.Queue()
+        for chunk in chunks:
+            self.chunks.put_nowait(chunk)
+
+    async def read(self, n=-1):
+        return await self.chunks.get()
+
+    def at_eof(self):
+        return False
+
+
+class _Transport:
+    def get_write_buffer_size(self):
+        return 0
+
+
+class _Writer:
+    will_echo = True
+    transport = _Transport()
+
+    def __init__(self):
+        self.output = []
+
+    def get_extra_info(self, name, default=None):
+        return {'cols': 80}.get(name, default)
+
+    def is_closing(self):
+        return False
+
+    def write(self, data):
+        self.output.append(data)
+
+
+def _position(*chunks, timeout=1.0):
+    async def main():
+        readline = Readline(_Reader(*chunks), _Writer())
+        try:
+            position = await readline.get_position(timeout)
+        except asyncio.TimeoutError:
+            position = None
+        return position, readline._readbuffer.popall()
+    return asyncio.run(main())
+
+
+def test_position_report_split_across_reads():
+    assert _position('ab\x1b[1', '2;3', '4Rcd\x1b[A') == ((12, 34), 'abcd\x1b[A')
+
+
+def test_position_report_after_other_escapes():
+    assert _position('x\x1b[Ay\x1b', '\x1b[5;7R') == ((5, 7), 'x\x1b[Ay\x1b')
+
+
+def test_position_timeout_keeps_typed_input():
+    assert _position('ab\x1b[1', '2;', timeout=0.05) == (None, 'ab\x1b[12;')
+
+
+def test_readline_consumes_typed_ahead_input():
+    async def main():
+        writer = _Writer()
+        readline = Readline(_Reader('hello\x7f\x1b[D!\rnext\r'), writer)
+        first = await readline.readline(offset=5)
+        second = await readline.readline(offset=5)
+        readline.flush()
+        return first, second, ''.join(writer.output)
+    first, second, output = asyncio.run(main())
+    assert (first, second) == ('hel!l', 'next')
+    assert output.startswith('hello\x08\x1b[K')
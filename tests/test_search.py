@@ -0,0 +1,65 @@
+import asyncio
+
+from bbs import search
+from bbs.models import Document, DocumentWriter, configure_database, models_cleanup, models_init
+from bbs.security import configure_hasher
+
+
+def _run(test):
+    async def main():
+        configure_hasher('thread')
+        configure_database('sqlite://:memory:')
+        await models_init(new=True)
+        try:
+            await test()
+        finally:
+            await models_cleanup()
+    asyncio.run(main())
+
+
+async def _save(document, text):
+    async with document.open_write() as writer:
+        await writer.write(text)
+
+
+def _paths(hits):
+    return [hit['path'] for hit in hits]
+
+
+def test_terms_in_different_chunks():
+    async def test():
+        root = await Document.get_root()
+        filler = 'filler ' * DocumentWriter.CHUNK_SIZE
+        split = await Document.make('split', root)
+        await _save(split, f'aardvark {filler} zebra')
+        assert await split.chunks.filter(version=split.version).count() > 1
+        alone = await Document.make('alone', root)
+        await _save(alone, 'aardvark only')
+
+        assert _paths(await search.search('aardvark zebra')) == ['/split']
+        assert sorted(_paths(await search.search('aardvark'))) == ['/alone', '/split']
+        assert await search.search('aardvark unicorn') == []
+    _run(test)
+
+
+def test_rewrite_replaces_index():
+    async def test():
+        root = await Document.get_root()
+        document = await Document.make('notes', root)
+        await _save(document, 'first draft')
+        await _save(document, 'second thoughts')
+
+        assert await search.search('draft') == []
+        assert _paths(await search.search('thoughts')) == ['/notes']
+    _run(test)
+
+
+def test_terms_are_quoted():
+    async def test():
+        root = await Document.get_root()
+        await _save(await Document.make('quoted', root), 'say "hello" AND NOT goodbye')
+
+        assert _paths(await search.search('"hello')) == ['/quoted']
+        assert _paths(await search.search('NOT')) == ['/quoted']
+        assert await search.search('   ') == []
+    _run(test)
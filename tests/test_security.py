@@ -0,0 +1,53 @@
+import hashlib
+import random
+
+import pytest
+
+from bbs.security import OfflineCorpus
+
+
+def _digest(i):
+    return hashlib.sha1(str(i).encode()).hexdigest().upper().encode()
+
+
+def _write(path, digests):
+    path.write_bytes(b''.join(b'%s:%d\r\n' % (d, i + 1) for i, d in enumerate(digests)))
+    return str(path)
+
+
+def test_lookups(tmp_path):
+    digests = sorted(_digest(i) for i in range(2000))
+    corpus = OfflineCorpus(_write(tmp_path / 'corpus.txt', digests))
+    try:
+        assert all(d in corpus for d in digests)
+        assert _digest(-1) not in corpus
+        assert b'0' * 40 not in corpus
+        assert b'F' * 40 not in corpus
+    finally:
+        corpus.close()
+
+
+def test_single_line_without_newline(tmp_path):
+    path = tmp_path / 'corpus.txt'
+    path.write_bytes(_digest(1) + b':3')
+    corpus = OfflineCorpus(str(path))
+    try:
+        assert _digest(1) in corpus
+        assert _digest(2) not in corpus
+    finally:
+        corpus.close()
+
+
+def test_empty(tmp_path):
+    path = tmp_path / 'corpus.txt'
+    path.write_bytes(b'')
+    corpus = OfflineCorpus(str(path))
+    assert _digest(1) not in corpus
+    corpus.close()
+
+
+def test_unsorted_is_refused(tmp_path):
+    digests = [_digest(i) for i in range(2000)]
+    random.Random(0).shuffle(digests)
+    with pytest.raises(ValueError, match='not sorted'):
+        OfflineCorpus(_write(tmp_path / 'corpus.txt', digests))